@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+""" Compares relaying the small client frames to the middle proxy one by one and in batches """
+
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import mtprotoproxy  # noqa: E402
+
+MSG_LENS = [16, 64, 512]
+FRAMES_IN_CHUNK = [1, 8, 64]
+CHUNKS_COUNT = 2000
+
+
+class LegacyIntermediateFrameStreamReader(mtprotoproxy.LayeredStreamReaderBase):
+    """ The reader which awaits two reads per frame, how it was done before """
+    __slots__ = ()
+
+    async def read(self, buf_size):
+        msg_len_bytes = await self.upstream.readexactly(4)
+        msg_len = int.from_bytes(msg_len_bytes, "little")
+
+        extra = {}
+        if msg_len > 0x80000000:
+            extra["QUICKACK_FLAG"] = True
+            msg_len -= 0x80000000
+
+        data = await self.upstream.readexactly(msg_len)
+        return data, extra
+
+
+class NullWriter:
+    """ Drops the rpc requests like the socket which is always ready """
+    def write(self, data):
+        pass
+
+
+class NullConfig:
+    AD_TAG = os.urandom(16)
+
+
+def make_stream(msg_len, frames_in_chunk):
+    frame = msg_len.to_bytes(4, "little") + os.urandom(msg_len)
+
+    stream = asyncio.StreamReader(limit=2**30)
+    for i in range(CHUNKS_COUNT):
+        stream.feed_data(frame * frames_in_chunk)
+    stream.feed_eof()
+    return stream
+
+
+def make_writer():
+    return mtprotoproxy.ProxyReqStreamWriter(NullWriter(), "127.0.0.1", 1, "127.0.0.1", 2,
+                                             mtprotoproxy.PROTO_TAG_INTERMEDIATE)
+
+
+async def relay_one_by_one(stream):
+    reader = LegacyIntermediateFrameStreamReader(stream)
+    writer = make_writer()
+    try:
+        while True:
+            data, extra = await reader.read(65536)
+            writer.write(data, extra)
+    except asyncio.IncompleteReadError:
+        pass
+
+
+async def relay_batches(stream):
+    reader = mtprotoproxy.MTProtoIntermediateFrameStreamReader(stream)
+    writer = make_writer()
+    while True:
+        frames = await reader.read_batch(65536)
+        if not frames:
+            break
+        writer.write_batch(frames)
+
+
+async def main():
+    mtprotoproxy.config = NullConfig()
+
+    print("%8s %8s %14s %14s" % ("msg", "frames", "one by one, us", "batches, us"))
+    for msg_len in MSG_LENS:
+        for frames_in_chunk in FRAMES_IN_CHUNK:
+            frames_count = CHUNKS_COUNT * frames_in_chunk
+            times = []
+            for relay in [relay_one_by_one, relay_batches]:
+                stream = make_stream(msg_len, frames_in_chunk)
+                start = time.perf_counter()
+                await relay(stream)
+                times.append((time.perf_counter() - start) / frames_count)
+            print("%8d %8d %14.2f %14.2f" % (msg_len, frames_in_chunk,
+                                             times[0] * 1e6, times[1] * 1e6))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+""" Measures the classic/secure and fake tls handshake cost depending on the number of users """
+
+import hashlib
+import hmac
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import mtprotoproxy  # noqa: E402
+
+USER_COUNTS = [1, 10, 100, 1000, 10000]
+MIN_BENCH_TIME = 0.5
+
+
+def load_config(users_count):
+    users = {"user%d" % i: "%032x" % (i + 1) for i in range(users_count)}
+    with tempfile.NamedTemporaryFile("w", suffix=".py", delete=False) as f:
+        f.write("USERS = %r\n" % users)
+        f.write('MODES = {"classic": True, "secure": True, "tls": True}\n')
+
+    sys.argv = [sys.argv[0], f.name]
+    try:
+        mtprotoproxy.init_config()
+    finally:
+        os.unlink(f.name)
+    mtprotoproxy.init_user_secrets()
+
+
+def gen_handshake(secret):
+    rnd = bytearray(os.urandom(mtprotoproxy.HANDSHAKE_LEN))
+    rnd[mtprotoproxy.PROTO_TAG_POS:mtprotoproxy.PROTO_TAG_POS+4] = mtprotoproxy.PROTO_TAG_SECURE
+
+    prekey_and_iv = rnd[mtprotoproxy.SKIP_LEN:mtprotoproxy.SKIP_LEN+48]
+    key = hashlib.sha256(bytes(prekey_and_iv[:32]) + secret).digest()
+    encryptor = mtprotoproxy.create_aes_ctr(key, int.from_bytes(prekey_and_iv[32:], "big"))
+    encrypted = encryptor.encrypt(bytes(rnd))
+    return bytes(rnd[:mtprotoproxy.PROTO_TAG_POS]) + encrypted[mtprotoproxy.PROTO_TAG_POS:]
+
+
+def gen_tls_handshake(secret):
+    DIGEST_POS = 11
+    DIGEST_LEN = 32
+
+    hello = bytearray(b"\x16\x03\x01\x02\x00" + os.urandom(512))
+    hello[DIGEST_POS:DIGEST_POS+DIGEST_LEN] = b"\x00" * DIGEST_LEN
+    digest = hmac.new(secret, hello, digestmod=hashlib.sha256).digest()
+    timestamp = int.to_bytes(int(time.time()), 4, "little")
+    xored = bytes(a ^ b for a, b in zip(digest, b"\x00" * (DIGEST_LEN - 4) + timestamp))
+    hello[DIGEST_POS:DIGEST_POS+DIGEST_LEN] = xored
+    return bytes(hello)
+
+
+def legacy_find_fake_tls_user(handshake):
+    """ The fresh hmac for every user, how it was done before the secrets precomputation """
+    DIGEST_POS = 11
+    DIGEST_LEN = 32
+
+    digest = handshake[DIGEST_POS:DIGEST_POS+DIGEST_LEN]
+
+    for user in mtprotoproxy.config.USERS:
+        secret = bytes.fromhex(mtprotoproxy.config.USERS[user])
+
+        msg = handshake[:DIGEST_POS] + b"\x00"*DIGEST_LEN + handshake[DIGEST_POS+DIGEST_LEN:]
+        computed_digest = hmac.new(secret, msg, digestmod=hashlib.sha256).digest()
+
+        xored_digest = bytes(digest[i] ^ computed_digest[i] for i in range(DIGEST_LEN))
+        if xored_digest.startswith(b"\x00" * (DIGEST_LEN-4)):
+            return user
+    return None
+
+
+def legacy_find_handshake_user(handshake):
+    """ The per user trial decryption, how it was done before the secrets precomputation """
+    dec_prekey_and_iv = handshake[8:56]
+    dec_prekey, dec_iv = dec_prekey_and_iv[:32], dec_prekey_and_iv[32:]
+    enc_prekey_and_iv = dec_prekey_and_iv[::-1]
+    enc_prekey, enc_iv = enc_prekey_and_iv[:32], enc_prekey_and_iv[32:]
+
+    for user in mtprotoproxy.config.USERS:
+        secret = bytes.fromhex(mtprotoproxy.config.USERS[user])
+
+        dec_key = hashlib.sha256(dec_prekey + secret).digest()
+        decryptor = mtprotoproxy.create_aes_ctr(key=dec_key, iv=int.from_bytes(dec_iv, "big"))
+
+        enc_key = hashlib.sha256(enc_prekey + secret).digest()
+        mtprotoproxy.create_aes_ctr(key=enc_key, iv=int.from_bytes(enc_iv, "big"))
+
+        decrypted = decryptor.decrypt(handshake)
+        if decrypted[56:60] == mtprotoproxy.PROTO_TAG_SECURE:
+            return user
+    return None
+
+
+def measure(func, *args):
+    iterations = 0
+    start = time.perf_counter()
+    while True:
+        func(*args)
+        iterations += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= MIN_BENCH_TIME:
+            return elapsed / iterations
+
+
+def main():
+    peer = ("127.0.0.1", 0)
+
+    print("%8s %14s %14s %14s %14s %14s" % (
+          "users", "legacy, us", "current, us", "bad, us", "tls legacy, us", "tls, us"))
+    for users_count in USER_COUNTS:
+        load_config(users_count)
+
+        # the worst case for the good client is the last user
+        last_user, last_secret, _ = mtprotoproxy.user_secrets[-1]
+        handshake = gen_handshake(last_secret)
+        assert mtprotoproxy.find_handshake_user(handshake, False)[0] == last_user
+        assert legacy_find_handshake_user(handshake) == last_user
+
+        tls_handshake = gen_tls_handshake(last_secret)
+        assert mtprotoproxy.find_fake_tls_user(tls_handshake, peer)[0] == last_user
+        assert legacy_find_fake_tls_user(tls_handshake) == last_user
+
+        bad_handshake = os.urandom(mtprotoproxy.HANDSHAKE_LEN)
+
+        legacy_time = measure(legacy_find_handshake_user, handshake)
+        current_time = measure(mtprotoproxy.find_handshake_user, handshake, False)
+        bad_time = measure(mtprotoproxy.find_handshake_user, bad_handshake, False)
+        tls_legacy_time = measure(legacy_find_fake_tls_user, tls_handshake)
+        tls_time = measure(mtprotoproxy.find_fake_tls_user, tls_handshake, peer)
+
+        print("%8d %14.1f %14.1f %14.1f %14.1f %14.1f" % (
+              users_count, legacy_time * 1e6, current_time * 1e6, bad_time * 1e6,
+              tls_legacy_time * 1e6, tls_time * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+""" Compares the speed of the bundled pyaes ctr mode and the batched keystream adapter """
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import pyaes  # noqa: E402
+
+import mtprotoproxy  # noqa: E402
+
+CHUNK_LENS = [64, 1024, 16384, 65536]
+TOTAL_LEN = 2**20
+
+
+def create_legacy_aes_ctr(key, iv):
+    """ The pyaes ctr mode, how it was done before the adapter """
+    return pyaes.AESModeOfOperationCTR(key, pyaes.Counter(iv))
+
+
+def bench_cipher(name, create_aes_ctr, key, iv, chunks):
+    cipher = create_aes_ctr(key, iv)
+
+    start = time.perf_counter()
+    out = [cipher.encrypt(chunk) for chunk in chunks]
+    enc_time = time.perf_counter() - start
+
+    speed = sum(map(len, chunks)) / enc_time / 2**20
+    print("%8d %20s %12.2f" % (len(chunks[0]), name, speed))
+    return b"".join(out)
+
+
+def main():
+    create_aes_ctr, create_aes_cbc = mtprotoproxy.use_slow_bundled_cryptography_module()
+
+    key = os.urandom(32)
+    iv = int.from_bytes(os.urandom(16), "big")
+
+    print("%8s %20s %12s" % ("chunk", "cipher", "MB/s"))
+    for chunk_len in CHUNK_LENS:
+        data = os.urandom(TOTAL_LEN)
+        chunks = [data[i:i+chunk_len] for i in range(0, TOTAL_LEN, chunk_len)]
+
+        legacy_out = bench_cipher("pyaes", create_legacy_aes_ctr, key, iv, chunks)
+        new_out = bench_cipher("batched", create_aes_ctr, key, iv, chunks)
+        if legacy_out != new_out:
+            print("outputs differ for chunk len %d" % chunk_len)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+""" Measures the small reads of the frame headers out of the big fake tls records """
+
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import mtprotoproxy  # noqa: E402
+
+RECORD_LEN = 16384
+RECORDS_COUNT = 64
+HEADER_LENS = [1, 4]
+
+
+class LegacyFakeTLSStreamReader(mtprotoproxy.FakeTLSStreamReader):
+    """ The reader which copies the rest of the buffer on every read, how it was done before """
+    __slots__ = ()
+
+    def __init__(self, upstream):
+        self.upstream = upstream
+        self.buf = bytearray()
+        self.buf_pos = 0  # never moves, the buffer is sliced instead
+
+    async def readexactly(self, n):
+        while len(self.buf) < n:
+            tls_data = await self.read(1, ignore_buf=True)
+            if not tls_data:
+                return b""
+            self.buf += tls_data
+        data, self.buf = self.buf[:n], self.buf[n:]
+        return bytes(data)
+
+
+class LegacyCryptoWrappedStreamReader(mtprotoproxy.CryptoWrappedStreamReader):
+    __slots__ = ()
+
+    def __init__(self, upstream, decryptor, block_size=1):
+        self.upstream = upstream
+        self.decryptor = decryptor
+        self.block_size = block_size
+        self.buf = bytearray()
+        self.buf_pos = 0  # never moves, the buffer is sliced instead
+
+    async def readexactly(self, n):
+        if n > len(self.buf):
+            to_read = n - len(self.buf)
+            needed_till_full_block = -to_read % self.block_size
+
+            to_read_block_aligned = to_read + needed_till_full_block
+            data = await self.upstream.readexactly(to_read_block_aligned)
+            self.buf += self.decryptor.decrypt(data)
+
+        ret = bytes(self.buf[:n])
+        self.buf = self.buf[n:]
+        return ret
+
+
+class NoDecryptor:
+    """ Keeps the data as is, only the buffering is measured """
+    def decrypt(self, data):
+        return data
+
+
+def make_tls_stream():
+    record = b"\x17\x03\x03" + RECORD_LEN.to_bytes(2, "big") + os.urandom(RECORD_LEN)
+
+    stream = asyncio.StreamReader(limit=2**30)
+    stream.feed_data(record * RECORDS_COUNT)
+    stream.feed_eof()
+    return stream
+
+
+async def bench_reader(name, create_reader, header_len):
+    reader = create_reader(make_tls_stream())
+    reads_count = RECORD_LEN * RECORDS_COUNT // header_len
+
+    start = time.perf_counter()
+    for i in range(reads_count):
+        await reader.readexactly(header_len)
+    read_time = (time.perf_counter() - start) / reads_count
+
+    print("%8d %30s %12.2f" % (header_len, name, read_time * 1e6))
+
+
+async def main():
+    readers = [
+        ("legacy tls", LegacyFakeTLSStreamReader),
+        ("tls", mtprotoproxy.FakeTLSStreamReader),
+        ("legacy crypto over legacy tls", lambda stream: LegacyCryptoWrappedStreamReader(
+            LegacyFakeTLSStreamReader(stream), NoDecryptor())),
+        ("crypto over tls", lambda stream: mtprotoproxy.CryptoWrappedStreamReader(
+            mtprotoproxy.FakeTLSStreamReader(stream), NoDecryptor())),
+    ]
+
+    print("%8s %30s %12s" % ("header", "reader", "read, us"))
+    for header_len in HEADER_LENS:
+        for name, create_reader in readers:
+            await bench_reader(name, create_reader, header_len)
+
+    print()
+    print("%8s %30s %12s" % ("len", "random", "read, us"))
+    for n in HEADER_LENS:
+        reads_count = 100000
+        start = time.perf_counter()
+        for i in range(reads_count):
+            mtprotoproxy.myrandom.getrandbytes(n)
+        read_time = (time.perf_counter() - start) / reads_count
+        print("%8d %30s %12.2f" % (n, "myrandom.getrandbytes", read_time * 1e6))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
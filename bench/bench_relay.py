@@ -0,0 +1,452 @@
+#!/usr/bin/env python3
+""" Measures the proxy end to end with a local fake telegram datacenter and a fake middle proxy
+
+The proxy is started in a child process for every crypto backend and route, the fake servers
+and the clients work in this process. The servers echo everything back, so the clients check
+the data they get and measure the round trip time.
+"""
+
+import asyncio
+import hashlib
+import hmac
+import importlib.util
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+# the child proxy process hides the faster crypto modules to use the slower ones
+BLOCKED_MODULES = {
+    "cryptography": [],
+    "pycryptodome": ["cryptography"],
+    "bundled": ["cryptography", "Crypto"],
+}
+
+if os.environ.get("BENCH_CRYPTO_BACKEND"):
+    for module in BLOCKED_MODULES[os.environ["BENCH_CRYPTO_BACKEND"]]:
+        sys.modules[module] = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import mtprotoproxy  # noqa: E402
+
+MODES = ["classic", "secure", "tls"]
+ROUTES = ["direct", "middle proxy"]
+CLIENTS_COUNT = 32
+PHASE_TIME = 3
+SMALL_MSG_LEN = 128
+BULK_MSG_LEN = 16384
+BULK_MSGS_IN_FLIGHT = 4
+PROXY_START_TIMEOUT = 10
+
+SECRET = "%032x" % 1
+AD_TAG = "3c09c680b76ee91a4c25ad51f742267d"
+
+RPC_NONCE = b"\xaa\x87\xcb\x7a"
+RPC_HANDSHAKE = b"\xf5\xee\x82\x76"
+RPC_PROXY_REQ = b"\xee\xf1\xce\x36"
+RPC_PROXY_ANS = b"\x0d\xda\x03\x44"
+
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def get_backends():
+    backends = []
+    if importlib.util.find_spec("cryptography"):
+        backends.append("cryptography")
+    if importlib.util.find_spec("Crypto"):
+        backends.append("pycryptodome")
+    backends.append("bundled")
+    return backends
+
+
+def get_process_cpu_time(pid):
+    """ Returns the user and system time of the process, None if there is no procfs """
+    try:
+        with open("/proc/%d/stat" % pid) as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+    utime, stime = int(fields[11]), int(fields[12])
+    return (utime + stime) / os.sysconf("SC_CLK_TCK")
+
+
+def run_proxy(config_path, dc_port, middle_proxy_port):
+    """ Runs the proxy pointed to the fake servers, it is launched in the child process """
+    async def do_nothing():
+        while True:
+            await asyncio.sleep(60)
+
+    sys.argv = [sys.argv[0], config_path]
+
+    mtprotoproxy.TG_DATACENTERS_V4 = ["127.0.0.1"] * len(mtprotoproxy.TG_DATACENTERS_V4)
+    mtprotoproxy.TG_DATACENTERS_V6 = []
+    mtprotoproxy.TG_DATACENTER_PORT = dc_port
+
+    dc_idxs = list(mtprotoproxy.TG_MIDDLE_PROXIES_V4)
+    mtprotoproxy.TG_MIDDLE_PROXIES_V4 = {i: [("127.0.0.1", middle_proxy_port)] for i in dc_idxs}
+    mtprotoproxy.TG_MIDDLE_PROXIES_V6 = {}
+
+    def init_ip_info():
+        mtprotoproxy.my_ip_info["ipv4"] = "127.0.0.1"
+
+    mtprotoproxy.init_ip_info = init_ip_info
+    mtprotoproxy.update_middle_proxy_info = do_nothing
+    mtprotoproxy.main()
+
+
+def start_proxy(backend, route, dc_port, middle_proxy_port):
+    port = get_free_port()
+    with tempfile.NamedTemporaryFile("w", suffix=".py", delete=False) as f:
+        f.write("PORT = %d\n" % port)
+        f.write("USERS = {'user': %r}\n" % SECRET)
+        f.write('MODES = {"classic": True, "secure": True, "tls": True}\n')
+        f.write('LISTEN_ADDR_IPV4 = "127.0.0.1"\n')
+        f.write("LISTEN_ADDR_IPV6 = None\n")
+        f.write("MASK = False\n")
+        f.write("GET_TIME_PERIOD = 0\n")
+        if route == "middle proxy":
+            f.write("AD_TAG = %r\n" % AD_TAG)
+
+    env = dict(os.environ, BENCH_CRYPTO_BACKEND=backend)
+    args = [sys.executable, os.path.abspath(__file__), "proxy", f.name,
+            str(dc_port), str(middle_proxy_port)]
+    proc = subprocess.Popen(args, env=env, stdout=subprocess.DEVNULL)
+
+    start = time.monotonic()
+    while time.monotonic() - start < PROXY_START_TIMEOUT:
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            break
+        except OSError:
+            time.sleep(0.1)
+    os.unlink(f.name)
+    return proc, port
+
+
+async def handle_fake_dc(reader, writer):
+    """ Answers the obfuscated2 handshake and echoes the data back """
+    try:
+        handshake = await reader.readexactly(mtprotoproxy.HANDSHAKE_LEN)
+        key_and_iv = handshake[mtprotoproxy.SKIP_LEN:mtprotoproxy.SKIP_LEN+48]
+        decryptor = mtprotoproxy.create_aes_ctr(key_and_iv[:32],
+                                                int.from_bytes(key_and_iv[32:], "big"))
+        key_and_iv = key_and_iv[::-1]
+        encryptor = mtprotoproxy.create_aes_ctr(key_and_iv[:32],
+                                                int.from_bytes(key_and_iv[32:], "big"))
+        decryptor.decrypt(handshake)
+
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            writer.write(encryptor.encrypt(decryptor.decrypt(data)))
+            await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.CancelledError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def handle_fake_middle_proxy(reader, writer):
+    """ Answers the rpc nonce and handshake and echoes the payloads of the proxy requests """
+    START_SEQ_NO = -2
+    UNENCRYPTED_PADDING_LEN = 4
+
+    try:
+        reader_tgt = mtprotoproxy.MTProtoFrameStreamReader(reader, START_SEQ_NO)
+        writer_tgt = mtprotoproxy.MTProtoFrameStreamWriter(writer, START_SEQ_NO)
+
+        msg = await reader_tgt.read(1)
+        key_selector, schema, crypto_ts, nonce_clt = msg[4:8], msg[8:12], msg[12:16], msg[16:32]
+        # the proxy pads the unencrypted frame, the answer is sent without the padding
+        await reader.readexactly(UNENCRYPTED_PADDING_LEN)
+
+        nonce_srv = os.urandom(16)
+        ans = RPC_NONCE + key_selector + schema + crypto_ts + nonce_srv
+        ans = int.to_bytes(len(ans) + 12, 4, "little") + int.to_bytes(START_SEQ_NO, 4, "little",
+                                                                     signed=True) + ans
+        writer.write(ans + int.to_bytes(mtprotoproxy.binascii.crc32(ans), 4, "little"))
+        writer_tgt.seq_no += 1
+
+        srv_ip, srv_port = writer.get_extra_info("sockname")[:2]
+        clt_ip, clt_port = writer.get_extra_info("peername")[:2]
+        key_args = dict(
+            nonce_srv=nonce_srv, nonce_clt=nonce_clt, clt_ts=crypto_ts,
+            srv_ip=socket.inet_pton(socket.AF_INET, srv_ip)[::-1],
+            clt_ip=socket.inet_pton(socket.AF_INET, clt_ip)[::-1],
+            srv_port=int.to_bytes(srv_port, 2, "little"),
+            clt_port=int.to_bytes(clt_port, 2, "little"),
+            middleproxy_secret=mtprotoproxy.PROXY_SECRET)
+
+        dec_key, dec_iv = mtprotoproxy.get_middleproxy_aes_key_and_iv(purpose=b"CLIENT",
+                                                                      **key_args)
+        enc_key, enc_iv = mtprotoproxy.get_middleproxy_aes_key_and_iv(purpose=b"SERVER",
+                                                                      **key_args)
+        reader_tgt.upstream = mtprotoproxy.CryptoWrappedStreamReader(
+            reader, mtprotoproxy.create_aes_cbc(dec_key, dec_iv), block_size=16)
+        writer_tgt.upstream = mtprotoproxy.CryptoWrappedStreamWriter(
+            writer, mtprotoproxy.create_aes_cbc(enc_key, enc_iv), block_size=16)
+
+        handshake = await reader_tgt.read(1)
+        sender_pid = handshake[8:20]
+        writer_tgt.write(RPC_HANDSHAKE + b"\x00" * 4 + sender_pid + sender_pid)
+        await writer.drain()
+
+        while True:
+            data = await reader_tgt.read(1)
+            if not data:
+                break
+            if data[:4] != RPC_PROXY_REQ:
+                continue
+            conn_id = data[8:16]
+            extra_len = int.from_bytes(data[56:60], "little")
+            writer_tgt.write(RPC_PROXY_ANS + b"\x00" * 4 + conn_id + data[60+extra_len:])
+            await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.CancelledError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+class BenchClient:
+    """ The telegram client which sends and gets the messages through the proxy """
+    def __init__(self, mode):
+        self.mode = mode
+        self.proto_tag = mtprotoproxy.PROTO_TAG_ABRIDGED
+        if mode in ("secure", "tls"):
+            self.proto_tag = mtprotoproxy.PROTO_TAG_SECURE
+        self.reader = None
+        self.writer = None
+        self.encryptor = None
+        self.decryptor = None
+        self.buf = bytearray()
+
+    async def connect(self, port):
+        secret = bytes.fromhex(SECRET)
+        self.reader, self.writer = await asyncio.open_connection("127.0.0.1", port)
+
+        if self.mode == "tls":
+            await self.do_tls_handshake(secret)
+
+        while True:
+            rnd = bytearray(os.urandom(mtprotoproxy.HANDSHAKE_LEN))
+            if rnd[0] != 0xef and rnd[:4] not in (b"\x16\x03\x01\x02",
+                                                  mtprotoproxy.PROTO_TAG_SECURE,
+                                                  mtprotoproxy.PROTO_TAG_INTERMEDIATE):
+                break
+        tag_pos = mtprotoproxy.PROTO_TAG_POS
+        rnd[tag_pos:tag_pos+4] = self.proto_tag
+        rnd[mtprotoproxy.DC_IDX_POS:mtprotoproxy.DC_IDX_POS+2] = int.to_bytes(2, 2, "little")
+
+        key_and_iv = bytes(rnd[mtprotoproxy.SKIP_LEN:mtprotoproxy.SKIP_LEN+48])
+        enc_key = hashlib.sha256(key_and_iv[:32] + secret).digest()
+        self.encryptor = mtprotoproxy.create_aes_ctr(enc_key,
+                                                     int.from_bytes(key_and_iv[32:], "big"))
+        key_and_iv = key_and_iv[::-1]
+        dec_key = hashlib.sha256(key_and_iv[:32] + secret).digest()
+        self.decryptor = mtprotoproxy.create_aes_ctr(dec_key,
+                                                     int.from_bytes(key_and_iv[32:], "big"))
+
+        encrypted = self.encryptor.encrypt(bytes(rnd))
+        self.write_raw(bytes(rnd[:tag_pos]) + encrypted[tag_pos:])
+
+    async def do_tls_handshake(self, secret):
+        DIGEST_POS = 11
+        DIGEST_LEN = 32
+        SESSION_ID_LEN_POS = 43
+
+        hello = bytearray(b"\x16\x03\x01\x02\x00" + os.urandom(512))
+        hello[SESSION_ID_LEN_POS] = 32
+        hello[DIGEST_POS:DIGEST_POS+DIGEST_LEN] = b"\x00" * DIGEST_LEN
+        digest = hmac.new(secret, hello, digestmod=hashlib.sha256).digest()
+        timestamp = int.to_bytes(int(time.time()), 4, "little")
+        xored = bytes(a ^ b for a, b in zip(digest, b"\x00" * (DIGEST_LEN - 4) + timestamp))
+        hello[DIGEST_POS:DIGEST_POS+DIGEST_LEN] = xored
+        self.writer.write(bytes(hello))
+
+        # server hello, change cipher spec and the fake certificate
+        for i in range(3):
+            header = await self.reader.readexactly(5)
+            await self.reader.readexactly(int.from_bytes(header[3:5], "big"))
+
+    def write_raw(self, data):
+        if self.mode != "tls":
+            self.writer.write(data)
+            return
+
+        MAX_RECORD_LEN = 16384
+        for pos in range(0, len(data), MAX_RECORD_LEN):
+            chunk = data[pos:pos+MAX_RECORD_LEN]
+            self.writer.write(b"\x17\x03\x03" + int.to_bytes(len(chunk), 2, "big") + chunk)
+
+    async def read_raw(self):
+        if self.mode != "tls":
+            data = await self.reader.read(65536)
+            if not data:
+                raise ConnectionResetError("the proxy closed the connection")
+            return data
+
+        while True:
+            header = await self.reader.readexactly(5)
+            data = await self.reader.readexactly(int.from_bytes(header[3:5], "big"))
+            if header[0] == 0x17:
+                return data
+
+    async def readexactly(self, n):
+        while len(self.buf) < n:
+            self.buf += self.decryptor.decrypt(await self.read_raw())
+        data = bytes(self.buf[:n])
+        del self.buf[:n]
+        return data
+
+    def send_msg(self, msg):
+        if self.proto_tag == mtprotoproxy.PROTO_TAG_ABRIDGED:
+            if len(msg) // 4 < 0x7f:
+                header = bytes([len(msg) // 4])
+            else:
+                header = b"\x7f" + int.to_bytes(len(msg) // 4, 3, "little")
+        else:
+            header = int.to_bytes(len(msg), 4, "little")
+        self.write_raw(self.encryptor.encrypt(header + msg))
+
+    async def recv_msg(self):
+        if self.proto_tag == mtprotoproxy.PROTO_TAG_ABRIDGED:
+            msg_len = (await self.readexactly(1))[0]
+            if msg_len == 0x7f:
+                msg_len = int.from_bytes(await self.readexactly(3), "little")
+            return await self.readexactly(msg_len * 4)
+
+        msg_len = int.from_bytes(await self.readexactly(4), "little")
+        msg = await self.readexactly(msg_len)
+        # the secure mode answers can be padded
+        return msg[:len(msg) // 4 * 4]
+
+    async def drain(self):
+        await self.writer.drain()
+
+    def close(self):
+        self.writer.close()
+
+
+async def bench_connects(port, mode):
+    """ Returns the number of the connections per second, each does one short exchange """
+    deadline = time.monotonic() + PHASE_TIME
+    connects = 0
+
+    async def connect_loop():
+        nonlocal connects
+        while time.monotonic() < deadline:
+            client = BenchClient(mode)
+            await client.connect(port)
+            msg = os.urandom(SMALL_MSG_LEN)
+            client.send_msg(msg)
+            if await client.recv_msg() != msg:
+                raise ValueError("bad echo")
+            client.close()
+            connects += 1
+
+    start = time.monotonic()
+    await asyncio.gather(*[connect_loop() for i in range(CLIENTS_COUNT)])
+    return connects / (time.monotonic() - start)
+
+
+async def bench_latency(port, mode):
+    """ Returns the round trip times of the small messages, one message in flight per client """
+    deadline = time.monotonic() + PHASE_TIME
+    round_trip_times = []
+
+    async def ping_loop():
+        client = BenchClient(mode)
+        await client.connect(port)
+        while time.monotonic() < deadline:
+            msg = os.urandom(SMALL_MSG_LEN)
+            start = time.monotonic()
+            client.send_msg(msg)
+            if await client.recv_msg() != msg:
+                raise ValueError("bad echo")
+            round_trip_times.append(time.monotonic() - start)
+        client.close()
+
+    await asyncio.gather(*[ping_loop() for i in range(CLIENTS_COUNT)])
+    round_trip_times.sort()
+    p50 = round_trip_times[len(round_trip_times) // 2]
+    p99 = round_trip_times[len(round_trip_times) * 99 // 100]
+    return p50, p99
+
+
+async def bench_throughput(port, mode):
+    """ Returns the number of bytes sent and got back by the clients and the time spent """
+    deadline = time.monotonic() + PHASE_TIME
+    total_bytes = 0
+
+    async def bulk_loop():
+        nonlocal total_bytes
+        client = BenchClient(mode)
+        await client.connect(port)
+        msgs_in_flight = []
+        while time.monotonic() < deadline or msgs_in_flight:
+            while time.monotonic() < deadline and len(msgs_in_flight) < BULK_MSGS_IN_FLIGHT:
+                msg = os.urandom(BULK_MSG_LEN)
+                client.send_msg(msg)
+                msgs_in_flight.append(msg)
+            await client.drain()
+            if await client.recv_msg() != msgs_in_flight.pop(0):
+                raise ValueError("bad echo")
+            total_bytes += BULK_MSG_LEN * 2
+        client.close()
+
+    start = time.monotonic()
+    await asyncio.gather(*[bulk_loop() for i in range(CLIENTS_COUNT)])
+    return total_bytes, time.monotonic() - start
+
+
+async def bench_proxy(backend, route, dc_port, middle_proxy_port):
+    proc, port = start_proxy(backend, route, dc_port, middle_proxy_port)
+    try:
+        for mode in MODES:
+            conns_per_sec = await bench_connects(port, mode)
+            p50, p99 = await bench_latency(port, mode)
+
+            cpu_before = get_process_cpu_time(proc.pid)
+            total_bytes, total_time = await bench_throughput(port, mode)
+            cpu_after = get_process_cpu_time(proc.pid)
+
+            mb_per_sec = total_bytes / total_time / 2**20
+            if cpu_before is not None and cpu_after is not None:
+                cpu_per_gb = "%10.1f" % ((cpu_after - cpu_before) / (total_bytes / 2**30))
+            else:
+                cpu_per_gb = "%10s" % "-"
+
+            print("%12s %12s %8s %10.1f %10.2f %10.2f %10.2f %s" % (
+                  route, backend, mode, conns_per_sec, mb_per_sec, p50 * 1000, p99 * 1000,
+                  cpu_per_gb), flush=True)
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+async def main():
+    fake_dc = await asyncio.start_server(handle_fake_dc, "127.0.0.1", 0)
+    fake_middle_proxy = await asyncio.start_server(handle_fake_middle_proxy, "127.0.0.1", 0)
+    dc_port = fake_dc.sockets[0].getsockname()[1]
+    middle_proxy_port = fake_middle_proxy.sockets[0].getsockname()[1]
+
+    print("%12s %12s %8s %10s %10s %10s %10s %10s" % (
+          "route", "backend", "mode", "conns/s", "MB/s", "p50, ms", "p99, ms", "cpu s/GB"))
+    for route in ROUTES:
+        for backend in get_backends():
+            await bench_proxy(backend, route, dc_port, middle_proxy_port)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 5 and sys.argv[1] == "proxy":
+        run_proxy(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]))
+    else:
+        asyncio.run(main())
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+""" Compares the memory and the speed of the replay check stores """
+
+import collections
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import mtprotoproxy  # noqa: E402
+
+STORE_LENS = [65536, 1048576]
+FP_RATE = 1e-6
+HANDSHAKE_LEN = 48
+
+
+class LegacyReplayCheck:
+    """ The ordered dict trimmed on every insert, how it was done before the stores """
+    def __init__(self, max_len):
+        self.max_len = max_len
+        self.handshakes = collections.OrderedDict()
+
+    def __contains__(self, handshake):
+        return handshake in self.handshakes
+
+    def add(self, handshake):
+        while len(self.handshakes) >= self.max_len:
+            self.handshakes.popitem(last=False)
+        self.handshakes[handshake] = True
+
+
+def bench_store(name, create_store, store_len):
+    handshakes = [os.urandom(HANDSHAKE_LEN) for i in range(store_len)]
+    new_handshakes = [os.urandom(HANDSHAKE_LEN) for i in range(min(store_len, 100000))]
+
+    tracemalloc.start()
+    mem_before = tracemalloc.get_traced_memory()[0]
+    store = create_store(store_len)
+    for handshake in handshakes:
+        store.add(handshake)
+    # the handshakes are kept in the list, so their memory isn't counted for the dicts
+    mem_used = tracemalloc.get_traced_memory()[0] - mem_before
+    tracemalloc.stop()
+
+    # the tracing slows the allocations down, so the time is measured on the new store
+    store = create_store(store_len)
+    start = time.perf_counter()
+    for handshake in handshakes:
+        store.add(handshake)
+    insert_time = (time.perf_counter() - start) / len(handshakes)
+
+    start = time.perf_counter()
+    false_positives = 0
+    for handshake in new_handshakes:
+        if handshake in store:
+            false_positives += 1
+    lookup_time = (time.perf_counter() - start) / len(new_handshakes)
+
+    assert all(handshake in store for handshake in handshakes[-1000:])
+
+    print("%10d %8s %12.2f %12.2f %12.2f %8d" % (
+          store_len, name, mem_used / 2**20, insert_time * 1e6, lookup_time * 1e6,
+          false_positives))
+
+
+def main():
+    print("%10s %8s %12s %12s %12s %8s" % (
+          "len", "store", "mem, MB", "insert, us", "lookup, us", "fp"))
+    for store_len in STORE_LENS:
+        bench_store("legacy", LegacyReplayCheck, store_len)
+        bench_store("dict", mtprotoproxy.ReplayCheckDict, store_len)
+        bench_store("bloom", lambda store_len: mtprotoproxy.ReplayCheckBloom(store_len, FP_RATE),
+                    store_len)
+
+
+if __name__ == "__main__":
+    main()
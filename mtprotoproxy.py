@@ -2,6 +2,7 @@
 
 import asyncio
 import socket
+import array
 import urllib.parse
 import urllib.request
 import collections
@@ -10,6 +11,7 @@ import datetime
 import hmac
 import base64
 import hashlib
+import math
 import random
 import binascii
 import sys
@@ -18,6 +20,7 @@ import runpy
 import signal
 import os
 import stat
+import struct
 import traceback
 
 
@@ -77,12 +80,17 @@ PADDING_FILLER = b"\x04\x00\x00\x00"
 MIN_MSG_LEN = 12
 MAX_MSG_LEN = 2 ** 24
 
+# the flag of the decoded client frames, it has the same bit as in the rpc proxy request
+FRAME_FLAG_QUICKACK = 0x80000000
+
 STAT_DURATION_BUCKETS = [0.1, 0.5, 1, 2, 5, 15, 60, 300, 600, 1800, 2**31 - 1]
+STATS_FLUSH_BYTES = 2 ** 20
+# the worker gauges are kept in the shared integer stats multiplied by this
+SHARED_GAUGE_SCALE = 10 ** 6
 
 my_ip_info = {"ipv4": None, "ipv6": None}
-used_handshakes = collections.OrderedDict()
-client_ips = collections.OrderedDict()
-last_client_ips = {}
+used_handshakes = None
+client_ips = None
 disable_middle_proxy = False
 is_time_skewed = False
 fake_cert_len = random.randrange(1024, 4096)
@@ -95,6 +103,16 @@ proxy_links = []
 stats = collections.Counter()
 user_stats = collections.defaultdict(collections.Counter)
 
+# the list of (user, secret bytes, hmac keyed with the secret), built on every config load
+user_secrets = []
+
+# in the multiprocess mode the stats are also summed in the shared memory
+shared_stats = None
+# in the multiprocess mode the telegram info polled by the first worker, see SharedTgInfo
+shared_tg_info = None
+# the index of the current worker process, None if there are no workers
+worker_idx = None
+
 config = {}
 
 
@@ -139,12 +157,28 @@ def init_config():
     # use middle proxy, necessary to show ad
     conf_dict.setdefault("USE_MIDDLE_PROXY", len(conf_dict["AD_TAG"]) == 16)
 
+    # number of shared connections to the middle proxies of every dc, the clients are multiplexed
+    # over them, when a shared connection dies all its clients are disconnected
+    # zero gives every client its own connection
+    conf_dict.setdefault("MIDDLE_PROXY_MUX_CONNS", 0)
+
     # if IPv6 avaliable, use it by default
     conf_dict.setdefault("PREFER_IPV6", socket.has_ipv6)
 
+    # if the telegram connect over the preferred ip version takes longer than this number of
+    # seconds, the other version is tried in parallel, zero disables it
+    conf_dict.setdefault("HAPPY_EYEBALLS_DELAY", 0.25)
+
     # disables tg->client trafic reencryption, faster but less secure
     conf_dict.setdefault("FAST_MODE", True)
 
+    # in the fast mode copy the tg->client trafic inside the kernel with splice, linux only
+    conf_dict.setdefault("USE_SPLICE", True)
+
+    # relay the plain direct connections with the buffered protocols instead of the streams,
+    # the data is read to the preallocated buffers and written straight to the other side
+    conf_dict.setdefault("USE_PROTOCOL_RELAY", True)
+
     # enables some working modes
     modes = conf_dict.get("MODES", {})
 
@@ -225,8 +259,19 @@ def init_config():
     conf_dict.setdefault("USER_DATA_QUOTA", {})
 
     # length of used handshake randoms for active fingerprinting protection, zero to disable
+    # the handshakes are remembered by count, not by time, so with N handshakes per second the
+    # replays are caught for about REPLAY_CHECK_LEN / N seconds, set it for the peak rate
     conf_dict.setdefault("REPLAY_CHECK_LEN", 65536)
 
+    # how to store the used handshake randoms: "dict" remembers them exactly, "bloom" uses
+    # much less memory, but rejects some good handshakes with REPLAY_CHECK_BLOOM_FP_RATE rate
+    conf_dict.setdefault("REPLAY_CHECK_STORE", "dict")
+    conf_dict.setdefault("REPLAY_CHECK_BLOOM_FP_RATE", 1e-6)
+
+    if conf_dict["REPLAY_CHECK_STORE"] not in ("dict", "bloom"):
+        print_err("Unknown REPLAY_CHECK_STORE %s, using dict" % conf_dict["REPLAY_CHECK_STORE"])
+        conf_dict["REPLAY_CHECK_STORE"] = "dict"
+
     # accept clients with bad clocks. This reduces the protection against replay attacks
     conf_dict.setdefault("IGNORE_TIME_SKEW", False)
 
@@ -236,6 +281,9 @@ def init_config():
     # delay in seconds between stats printing
     conf_dict.setdefault("STATS_PRINT_PERIOD", 600)
 
+    # the connections flush their traffic stats after this delay, zero makes the stats exact
+    conf_dict.setdefault("STATS_FLUSH_PERIOD", 1)
+
     # delay in seconds between middle proxy info updates
     conf_dict.setdefault("PROXY_INFO_UPDATE_PERIOD", 24*60*60)
 
@@ -264,6 +312,13 @@ def init_config():
     # telegram servers connect timeout in seconds
     conf_dict.setdefault("TG_CONNECT_TIMEOUT", 10)
 
+    # the pooled telegram connections are replaced with the new ones after this time in secs
+    conf_dict.setdefault("TG_POOL_CONN_MAX_AGE", 2*60)
+
+    # the pooled telegram connections are checked with tcp keepalives with this interval,
+    # so the connections dropped by NATs are noticed before a client gets them, zero to disable
+    conf_dict.setdefault("TG_POOL_PROBE_INTERVAL", 15)
+
     # listen address for IPv4
     conf_dict.setdefault("LISTEN_ADDR_IPV4", "0.0.0.0")
 
@@ -273,6 +328,10 @@ def init_config():
     # listen unix socket
     conf_dict.setdefault("LISTEN_UNIX_SOCK", "")
 
+    # number of worker processes, each one has its own event loop and listening socket
+    # the stats and the user limits are shared between the workers, unix only
+    conf_dict.setdefault("WORKERS", 1)
+
     # prometheus exporter listen port, use some random port here
     conf_dict.setdefault("METRICS_PORT", None)
 
@@ -360,27 +419,164 @@ def use_slow_bundled_cryptography_module():
     msg += "pip install cryptography\n"
     print(msg, flush=True, file=sys.stderr)
 
-    class BundledEncryptorAdapter:
-        __slots__ = ('mode', )
+    # the lookup tables of pyaes, the s-boxes are pre-shifted for the last round
+    T1, T2, T3, T4 = pyaes.AES.T1, pyaes.AES.T2, pyaes.AES.T3, pyaes.AES.T4
+    T5, T6, T7, T8 = pyaes.AES.T5, pyaes.AES.T6, pyaes.AES.T7, pyaes.AES.T8
+    S24, S16, S8, S0 = [[s << shift for s in pyaes.AES.S] for shift in (24, 16, 8, 0)]
+    Si24, Si16, Si8, Si0 = [[s << shift for s in pyaes.AES.Si] for shift in (24, 16, 8, 0)]
+
+    def get_round_keys(round_keys):
+        # pyaes keeps some round key words negative
+        return [tuple(word & 0xffffffff for word in round_key) for round_key in round_keys]
 
-        def __init__(self, mode):
-            self.mode = mode
+    class BundledCBCAdapter:
+        # the whole aligned buffer is processed in one pass with the unrolled table lookups
+        __slots__ = ('enc_round_keys', 'dec_round_keys', 'last_block')
+
+        def __init__(self, key, iv):
+            aes = pyaes.AES(key)
+            self.enc_round_keys = get_round_keys(aes._Ke)
+            self.dec_round_keys = get_round_keys(aes._Kd)
+            self.last_block = int.from_bytes(iv, "big")
 
         def encrypt(self, data):
-            encrypter = pyaes.Encrypter(self.mode, pyaes.PADDING_NONE)
-            return encrypter.feed(data) + encrypter.feed()
+            if len(data) % 16 != 0:
+                raise ValueError("data len is not a multiple of the block size")
+
+            (k0, k1, k2, k3), *middle_round_keys, (l0, l1, l2, l3) = self.enc_round_keys
+            last_block = self.last_block
+
+            words = []
+            for pos in range(0, len(data), 16):
+                block = int.from_bytes(data[pos:pos+16], "big") ^ last_block
+                t0 = (block >> 96) ^ k0
+                t1 = (block >> 64) & 0xffffffff ^ k1
+                t2 = (block >> 32) & 0xffffffff ^ k2
+                t3 = block & 0xffffffff ^ k3
+
+                for r0, r1, r2, r3 in middle_round_keys:
+                    t0, t1, t2, t3 = (
+                        T1[t0 >> 24] ^ T2[t1 >> 16 & 255] ^ T3[t2 >> 8 & 255] ^ T4[t3 & 255] ^ r0,
+                        T1[t1 >> 24] ^ T2[t2 >> 16 & 255] ^ T3[t3 >> 8 & 255] ^ T4[t0 & 255] ^ r1,
+                        T1[t2 >> 24] ^ T2[t3 >> 16 & 255] ^ T3[t0 >> 8 & 255] ^ T4[t1 & 255] ^ r2,
+                        T1[t3 >> 24] ^ T2[t0 >> 16 & 255] ^ T3[t1 >> 8 & 255] ^ T4[t2 & 255] ^ r3
+                    )
+
+                w0 = (S24[t0 >> 24] | S16[t1 >> 16 & 255] | S8[t2 >> 8 & 255] | S0[t3 & 255]) ^ l0
+                w1 = (S24[t1 >> 24] | S16[t2 >> 16 & 255] | S8[t3 >> 8 & 255] | S0[t0 & 255]) ^ l1
+                w2 = (S24[t2 >> 24] | S16[t3 >> 16 & 255] | S8[t0 >> 8 & 255] | S0[t1 & 255]) ^ l2
+                w3 = (S24[t3 >> 24] | S16[t0 >> 16 & 255] | S8[t1 >> 8 & 255] | S0[t2 & 255]) ^ l3
+                words += (w0, w1, w2, w3)
+                last_block = w0 << 96 | w1 << 64 | w2 << 32 | w3
+
+            self.last_block = last_block
+            return struct.pack(">%dI" % len(words), *words)
 
         def decrypt(self, data):
-            decrypter = pyaes.Decrypter(self.mode, pyaes.PADDING_NONE)
-            return decrypter.feed(data) + decrypter.feed()
+            if len(data) % 16 != 0:
+                raise ValueError("data len is not a multiple of the block size")
+
+            (k0, k1, k2, k3), *middle_round_keys, (l0, l1, l2, l3) = self.dec_round_keys
+            last_block = self.last_block
+
+            blocks = []
+            for pos in range(0, len(data), 16):
+                block = int.from_bytes(data[pos:pos+16], "big")
+                t0 = (block >> 96) ^ k0
+                t1 = (block >> 64) & 0xffffffff ^ k1
+                t2 = (block >> 32) & 0xffffffff ^ k2
+                t3 = block & 0xffffffff ^ k3
+
+                for r0, r1, r2, r3 in middle_round_keys:
+                    t0, t1, t2, t3 = (
+                        T5[t0 >> 24] ^ T6[t3 >> 16 & 255] ^ T7[t2 >> 8 & 255] ^ T8[t1 & 255] ^ r0,
+                        T5[t1 >> 24] ^ T6[t0 >> 16 & 255] ^ T7[t3 >> 8 & 255] ^ T8[t2 & 255] ^ r1,
+                        T5[t2 >> 24] ^ T6[t1 >> 16 & 255] ^ T7[t0 >> 8 & 255] ^ T8[t3 & 255] ^ r2,
+                        T5[t3 >> 24] ^ T6[t2 >> 16 & 255] ^ T7[t1 >> 8 & 255] ^ T8[t0 & 255] ^ r3
+                    )
+
+                w0 = (Si24[t0 >> 24] | Si16[t3 >> 16 & 255] | Si8[t2 >> 8 & 255] |
+                      Si0[t1 & 255]) ^ l0
+                w1 = (Si24[t1 >> 24] | Si16[t0 >> 16 & 255] | Si8[t3 >> 8 & 255] |
+                      Si0[t2 & 255]) ^ l1
+                w2 = (Si24[t2 >> 24] | Si16[t1 >> 16 & 255] | Si8[t0 >> 8 & 255] |
+                      Si0[t3 & 255]) ^ l2
+                w3 = (Si24[t3 >> 24] | Si16[t2 >> 16 & 255] | Si8[t1 >> 8 & 255] |
+                      Si0[t0 & 255]) ^ l3
+                blocks.append((w0 << 96 | w1 << 64 | w2 << 32 | w3) ^ last_block)
+                last_block = block
+
+            self.last_block = last_block
+            return b"".join(block.to_bytes(16, "big") for block in blocks)
+
+    class BundledCTRAdapter:
+        # the keystream is made by batches of blocks, the data is xored as one integer
+        __slots__ = ('round_keys', 'last_round_key', 'counter', 'keystream', 'keystream_pos')
+
+        BATCH_BLOCKS = 256
+
+        def __init__(self, key, iv):
+            round_keys = get_round_keys(pyaes.AES(key)._Ke)
+            self.round_keys = round_keys[:-1]
+            self.last_round_key = round_keys[-1]
+            self.counter = iv
+            self.keystream = b""
+            self.keystream_pos = 0
+
+        def make_keystream(self, blocks_count):
+            (k0, k1, k2, k3), *middle_round_keys = self.round_keys
+            l0, l1, l2, l3 = self.last_round_key
+
+            words = []
+            for counter in range(self.counter, self.counter + blocks_count):
+                counter &= 0xffffffffffffffffffffffffffffffff
+                t0 = (counter >> 96) ^ k0
+                t1 = (counter >> 64) & 0xffffffff ^ k1
+                t2 = (counter >> 32) & 0xffffffff ^ k2
+                t3 = counter & 0xffffffff ^ k3
+
+                for r0, r1, r2, r3 in middle_round_keys:
+                    t0, t1, t2, t3 = (
+                        T1[t0 >> 24] ^ T2[t1 >> 16 & 255] ^ T3[t2 >> 8 & 255] ^ T4[t3 & 255] ^ r0,
+                        T1[t1 >> 24] ^ T2[t2 >> 16 & 255] ^ T3[t3 >> 8 & 255] ^ T4[t0 & 255] ^ r1,
+                        T1[t2 >> 24] ^ T2[t3 >> 16 & 255] ^ T3[t0 >> 8 & 255] ^ T4[t1 & 255] ^ r2,
+                        T1[t3 >> 24] ^ T2[t0 >> 16 & 255] ^ T3[t1 >> 8 & 255] ^ T4[t2 & 255] ^ r3
+                    )
+
+                words.append((S24[t0 >> 24] | S16[t1 >> 16 & 255] | S8[t2 >> 8 & 255] |
+                              S0[t3 & 255]) ^ l0)
+                words.append((S24[t1 >> 24] | S16[t2 >> 16 & 255] | S8[t3 >> 8 & 255] |
+                              S0[t0 & 255]) ^ l1)
+                words.append((S24[t2 >> 24] | S16[t3 >> 16 & 255] | S8[t0 >> 8 & 255] |
+                              S0[t1 & 255]) ^ l2)
+                words.append((S24[t3 >> 24] | S16[t0 >> 16 & 255] | S8[t1 >> 8 & 255] |
+                              S0[t2 & 255]) ^ l3)
+
+            self.counter = (self.counter + blocks_count) & 0xffffffffffffffffffffffffffffffff
+            return struct.pack(">%dI" % len(words), *words)
+
+        def encrypt(self, data):
+            data_len = len(data)
+            if data_len > len(self.keystream) - self.keystream_pos:
+                rest = self.keystream[self.keystream_pos:]
+                blocks_count = max((data_len - len(rest) + 15) // 16, self.BATCH_BLOCKS)
+                self.keystream = rest + self.make_keystream(blocks_count)
+                self.keystream_pos = 0
+
+            pos = self.keystream_pos
+            keystream = self.keystream[pos:pos+data_len]
+            self.keystream_pos = pos + data_len
+
+            xored = int.from_bytes(data, "big") ^ int.from_bytes(keystream, "big")
+            return xored.to_bytes(data_len, "big")
+
+        decrypt = encrypt
 
     def create_aes_ctr(key, iv):
-        ctr = pyaes.Counter(iv)
-        return pyaes.AESModeOfOperationCTR(key, ctr)
+        return BundledCTRAdapter(key, iv)
 
     def create_aes_cbc(key, iv):
-        mode = pyaes.AESModeOfOperationCBC(key, iv)
-        return BundledEncryptorAdapter(mode)
+        return BundledCBCAdapter(key, iv)
     return create_aes_ctr, create_aes_cbc
 
 
@@ -404,20 +600,274 @@ def ensure_users_in_user_stats():
         user_stats[user].update()
 
 
+def init_user_secrets():
+    global user_secrets
+    user_secrets = []
+    for user, secret in config.USERS.items():
+        secret = bytes.fromhex(secret)
+        # the hmac is copied for every digest, so the key is processed only once
+        secret_hmac = hmac.new(secret, digestmod=hashlib.sha256)
+        user_secrets.append((user, secret, secret_hmac))
+
+
 def init_proxy_start_time():
     global proxy_start_time
     proxy_start_time = time.time()
 
 
+class SharedStats:
+    # the counters have one cell per worker, so the updates need no lock
+    KEY_LEN = 256
+    HEADER_LEN = 8
+
+    def __init__(self, workers_count, max_keys):
+        import mmap
+        import multiprocessing
+
+        self.workers_count = workers_count
+        self.max_keys = max_keys
+        self.lock = multiprocessing.Lock()
+
+        self.keys_mem = mmap.mmap(-1, self.HEADER_LEN + max_keys * self.KEY_LEN)
+        self.vals_mem = mmap.mmap(-1, max_keys * workers_count * 8)
+        self.keys_count = memoryview(self.keys_mem)[:self.HEADER_LEN].cast("q")
+        self.vals = memoryview(self.vals_mem).cast("q")
+
+        self.key_to_idx = {}
+        self.idx_to_key = []
+        self.is_overflow_reported = False
+
+    def sync_keys(self):
+        # should be called with the lock held
+        for idx in range(len(self.idx_to_key), self.keys_count[0]):
+            pos = self.HEADER_LEN + idx * self.KEY_LEN
+            key = self.keys_mem[pos:pos+self.KEY_LEN].rstrip(b"\x00").decode("utf8")
+            self.idx_to_key.append(key)
+            self.key_to_idx[key] = idx
+
+    def get_key_idx(self, key):
+        idx = self.key_to_idx.get(key)
+        if idx is not None:
+            return idx
+
+        with self.lock:
+            self.sync_keys()
+            if key in self.key_to_idx:
+                return self.key_to_idx[key]
+
+            key_bytes = key.encode("utf8")
+            idx = self.keys_count[0]
+            if idx >= self.max_keys or len(key_bytes) >= self.KEY_LEN:
+                if not self.is_overflow_reported:
+                    print_err("Not enough shared memory for stats, some stats are per worker")
+                    self.is_overflow_reported = True
+                return None
+
+            pos = self.HEADER_LEN + idx * self.KEY_LEN
+            self.keys_mem[pos:pos+len(key_bytes)] = key_bytes
+            self.keys_count[0] = idx + 1
+
+            self.idx_to_key.append(key)
+            self.key_to_idx[key] = idx
+            return idx
+
+    def add(self, key, val):
+        idx = self.get_key_idx(key)
+        if idx is not None:
+            self.vals[idx * self.workers_count + worker_idx] += val
+
+    def set(self, key, val):
+        idx = self.get_key_idx(key)
+        if idx is not None:
+            self.vals[idx * self.workers_count + worker_idx] = val
+
+    def get(self, key):
+        idx = self.get_key_idx(key)
+        if idx is None:
+            return 0
+        return sum(self.vals[idx * self.workers_count:(idx + 1) * self.workers_count])
+
+    def get_per_worker(self, key_prefix):
+        with self.lock:
+            self.sync_keys()
+
+        ret = {}
+        for idx, key in enumerate(self.idx_to_key):
+            if key.startswith(key_prefix):
+                pos = idx * self.workers_count
+                ret[key] = self.vals[pos:pos + self.workers_count].tolist()
+        return ret
+
+    def get_all(self):
+        with self.lock:
+            self.sync_keys()
+
+        ret = {}
+        for idx, key in enumerate(self.idx_to_key):
+            ret[key] = sum(self.vals[idx * self.workers_count:(idx + 1) * self.workers_count])
+        return ret
+
+    def reset_worker(self, worker_to_reset, key_prefixes):
+        # used to drop the gauges of the dead worker
+        with self.lock:
+            self.sync_keys()
+
+        for idx, key in enumerate(self.idx_to_key):
+            if key.startswith(key_prefixes):
+                self.vals[idx * self.workers_count + worker_to_reset] = 0
+
+
+class SharedTgInfo:
+    # the first worker polls the telegram servers and publishes the info here
+    HEADER_LEN = 16
+    MEM_LEN = 2 ** 16
+
+    def __init__(self):
+        import mmap
+        import multiprocessing
+
+        self.lock = multiprocessing.Lock()
+        self.mem = mmap.mmap(-1, self.MEM_LEN)
+        # the version and the length of the data
+        self.header = memoryview(self.mem)[:self.HEADER_LEN].cast("q")
+        self.loaded_version = 0
+
+    def publish(self, info):
+        import json
+
+        data = json.dumps(info).encode("utf8")
+        if len(data) > self.MEM_LEN - self.HEADER_LEN:
+            print_err("Not enough shared memory for the telegram info, it is not shared")
+            return
+
+        with self.lock:
+            self.mem[self.HEADER_LEN:self.HEADER_LEN+len(data)] = data
+            self.header[1] = len(data)
+            self.header[0] += 1
+
+    def load(self):
+        # None if nothing was published after the last load
+        import json
+
+        with self.lock:
+            version, data_len = self.header[0], self.header[1]
+            if version == self.loaded_version:
+                return None
+            data = self.mem[self.HEADER_LEN:self.HEADER_LEN+data_len]
+
+        self.loaded_version = version
+        return json.loads(data.decode("utf8"))
+
+
 def update_stats(**kw_stats):
     global stats
     stats.update(**kw_stats)
 
+    if shared_stats:
+        for stat, val in kw_stats.items():
+            shared_stats.add("s:%s" % stat, val)
+
 
 def update_user_stats(user, **kw_stats):
     global user_stats
     user_stats[user].update(**kw_stats)
 
+    # the total connects count is kept in the stats to get it without the users scanning
+    if "curr_connects" in kw_stats:
+        update_stats(curr_connects=kw_stats["curr_connects"])
+
+    if shared_stats:
+        for stat, val in kw_stats.items():
+            shared_stats.add("u:%s:%s" % (stat, user), val)
+
+
+def get_user_stat(user, stat):
+    # summed over all the workers
+    if shared_stats:
+        return shared_stats.get("u:%s:%s" % (stat, user))
+    return user_stats[user][stat]
+
+
+def get_total_stats():
+    # summed over all the workers
+    if not shared_stats:
+        return stats, user_stats
+
+    total_stats = collections.Counter()
+    total_user_stats = collections.defaultdict(collections.Counter)
+    for user in user_stats:
+        total_user_stats[user].update()
+
+    for key, val in shared_stats.get_all().items():
+        if key.startswith("s:"):
+            total_stats[key[2:]] = val
+        elif key.startswith("u:"):
+            stat, user = key[2:].split(":", 1)
+            total_user_stats[user][stat] = val
+    return total_stats, total_user_stats
+
+
+def get_worker_gauges():
+    # the (name, labels, val) gauges of this worker
+    global tg_connection_pool
+    global tg_endpoint_scores
+    global client_ips
+
+    gauges = []
+    for (host, port, init_func), counts in tg_connection_pool.get_warm_counts().items():
+        pool_type = "middle_proxy" if init_func else "direct"
+        labels = {"host": "%s:%d" % (host, port), "type": pool_type}
+        gauges.append(("tg_pool_warm_conns", labels, counts[0]))
+        gauges.append(("tg_pool_target_conns", labels, counts[1]))
+
+    for (host, port), score in tg_endpoint_scores.scores.items():
+        labels = {"host": "%s:%d" % (host, port)}
+        gauges.append(("tg_endpoint_connect_time", labels, score.connect_time))
+        gauges.append(("tg_endpoint_failures", labels, score.failures))
+
+    gauges.append(("client_ips", {}, len(client_ips)))
+    gauges.append(("client_ips_mem", {}, client_ips.get_mem_size()))
+    return gauges
+
+
+def publish_worker_gauges():
+    # the gone gauges are zeroed
+    if not shared_stats:
+        return
+
+    stale_keys = set(shared_stats.get_per_worker("g:"))
+    for name, labels, val in get_worker_gauges():
+        labels_str = ",".join("%s=%s" % (label, labels[label]) for label in sorted(labels))
+        key = "g:%s:%s" % (name, labels_str)
+        shared_stats.set(key, round(val * SHARED_GAUGE_SCALE))
+        stale_keys.discard(key)
+
+    for key in stale_keys:
+        shared_stats.set(key, 0)
+
+
+def get_all_worker_gauges():
+    # the worker label is added when there are many workers
+    if not shared_stats:
+        gauges = get_worker_gauges()
+        gauges.sort(key=lambda gauge: gauge[0])
+        return gauges
+
+    publish_worker_gauges()
+
+    gauges = []
+    for key, vals in shared_stats.get_per_worker("g:").items():
+        name, labels_str = key[2:].split(":", 1)
+        for worker, val in enumerate(vals):
+            labels = dict(label.split("=", 1) for label in labels_str.split(",") if label)
+            labels["worker"] = str(worker)
+            val /= SHARED_GAUGE_SCALE
+            gauges.append((name, labels, int(val) if val.is_integer() else val))
+
+    # the samples of one metric must go together
+    gauges.sort(key=lambda gauge: gauge[0])
+    return gauges
+
 
 def update_durations(duration):
     global stats
@@ -430,12 +880,11 @@ def update_durations(duration):
 
 
 def get_curr_connects_count():
-    global user_stats
+    global stats
 
-    all_connects = 0
-    for user, stat in user_stats.items():
-        all_connects += stat["curr_connects"]
-    return all_connects
+    if shared_stats:
+        return shared_stats.get("s:curr_connects")
+    return stats["curr_connects"]
 
 
 def get_to_tg_bufsize():
@@ -462,6 +911,7 @@ class MyRandom(random.Random):
 
         self.encryptor = create_aes_ctr(key, iv)
         self.buffer = bytearray()
+        self.buffer_pos = 0
 
     def getrandbits(self, k):
         numbytes = (k + 7) // 8
@@ -470,25 +920,431 @@ class MyRandom(random.Random):
     def getrandbytes(self, n):
         CHUNK_SIZE = 512
 
-        while n > len(self.buffer):
+        while n > len(self.buffer) - self.buffer_pos:
             data = int.to_bytes(super().getrandbits(CHUNK_SIZE*8), CHUNK_SIZE, "big")
+            del self.buffer[:self.buffer_pos]
+            self.buffer_pos = 0
             self.buffer += self.encryptor.encrypt(data)
 
-        result = self.buffer[:n]
-        self.buffer = self.buffer[n:]
-        return bytes(result)
+        pos = self.buffer_pos
+        self.buffer_pos += n
+        return bytes(self.buffer[pos:pos+n])
 
 
 myrandom = MyRandom()
 
 
+class ReplayCheckDict:
+    def __init__(self, max_len):
+        self.max_len = max_len
+        self.handshakes = collections.OrderedDict()
+
+    def __contains__(self, handshake):
+        return handshake in self.handshakes
+
+    def add(self, handshake):
+        if self.max_len <= 0:
+            return
+
+        while len(self.handshakes) >= self.max_len:
+            self.handshakes.popitem(last=False)
+        self.handshakes[handshake] = True
+
+
+class ReplayCheckBloom:
+    # two generations of bloom filters, they rotate by the handshakes count, not by time
+    HEADER_LEN = 16
+
+    def __init__(self, max_len, fp_rate, shared=False):
+        # the lookup checks both generations, so each of them gets a half of the rate
+        gen_fp_rate = fp_rate / 2
+
+        self.max_len = max_len
+        self.bits_count = max(64, int(-max_len * math.log(gen_fp_rate) / math.log(2) ** 2))
+        self.hashes_count = max(1, round(self.bits_count / max_len * math.log(2)))
+        self.salt = os.urandom(16)
+
+        gen_len = (self.bits_count + 7) // 8
+        mem_len = self.HEADER_LEN + 2 * gen_len
+
+        if shared:
+            import mmap
+            import multiprocessing
+
+            self.mem = mmap.mmap(-1, mem_len)
+            self.lock = multiprocessing.Lock()
+        else:
+            self.mem = bytearray(mem_len)
+            self.lock = None
+
+        # the header has the current generation number and its length
+        self.header = memoryview(self.mem)[:self.HEADER_LEN].cast("q")
+        self.gens = [
+            memoryview(self.mem)[self.HEADER_LEN:self.HEADER_LEN+gen_len],
+            memoryview(self.mem)[self.HEADER_LEN+gen_len:]
+        ]
+
+    def get_bit_positions(self, handshake):
+        digest = hashlib.blake2b(handshake, digest_size=16, key=self.salt).digest()
+        hash1 = int.from_bytes(digest[:8], "little")
+        hash2 = int.from_bytes(digest[8:], "little") | 1
+
+        return [(hash1 + i * hash2) % self.bits_count for i in range(self.hashes_count)]
+
+    def __contains__(self, handshake):
+        positions = self.get_bit_positions(handshake)
+
+        for gen in self.gens:
+            if all(gen[pos >> 3] & (1 << (pos & 7)) for pos in positions):
+                return True
+        return False
+
+    def set_bits(self, positions):
+        curr_gen_idx, curr_gen_len = self.header
+
+        if curr_gen_len >= self.max_len:
+            # the oldest generation is cleared and becomes current
+            curr_gen_idx ^= 1
+            curr_gen_len = 0
+            self.gens[curr_gen_idx][:] = bytes(len(self.gens[curr_gen_idx]))
+
+        gen = self.gens[curr_gen_idx]
+        for pos in positions:
+            gen[pos >> 3] |= 1 << (pos & 7)
+
+        self.header[0] = curr_gen_idx
+        self.header[1] = curr_gen_len + 1
+
+    def add(self, handshake):
+        positions = self.get_bit_positions(handshake)
+
+        if self.lock:
+            with self.lock:
+                self.set_bits(positions)
+        else:
+            self.set_bits(positions)
+
+
+def init_used_handshakes():
+    global used_handshakes
+
+    if config.REPLAY_CHECK_STORE == "bloom" and config.REPLAY_CHECK_LEN > 0:
+        # the workers get the store from the supervisor, so it is shared from the start
+        params = (ReplayCheckBloom, config.REPLAY_CHECK_LEN, config.REPLAY_CHECK_BLOOM_FP_RATE,
+                  is_multiprocess_mode())
+    else:
+        params = (ReplayCheckDict, config.REPLAY_CHECK_LEN)
+
+    # on the config reload keep the used handshakes if the store settings are the same
+    if used_handshakes is not None and used_handshakes.params == params:
+        return
+
+    # the workers share the store made by the supervisor before the fork, the store made on
+    # the reload would be private to the worker, so the new settings need a restart
+    if used_handshakes is not None and shared_stats:
+        if worker_idx is None:
+            print_err("The replay check store settings are changed, restart to apply them")
+        return
+
+    store_class, *store_args = params
+    used_handshakes = store_class(*store_args)
+    used_handshakes.params = params
+
+
+class ClientIPs:
+    # the packed ips in a ring with an open addressing index, no python objects per ip
+    ADDR_LEN = 16
+    EMPTY = -1
+
+    def __init__(self, max_len):
+        self.max_len = max_len
+        self.addrs = bytearray(max_len * self.ADDR_LEN)
+        self.next_slot = 0
+        self.len = 0
+
+        # the index is at least two times bigger than the ring to keep the probe chains short
+        index_len = 1
+        while index_len < 2 * max_len:
+            index_len *= 2
+        self.index_mask = index_len - 1
+        self.index = array.array("i", [self.EMPTY]) * index_len
+
+        # the new ips since the last print, also limited by max_len
+        self.new_ips = []
+
+    @staticmethod
+    def pack_ip(ip):
+        try:
+            return b"\x00" * 10 + b"\xff\xff" + socket.inet_pton(socket.AF_INET, ip)
+        except OSError:
+            pass
+
+        try:
+            return socket.inet_pton(socket.AF_INET6, ip)
+        except OSError:
+            return None
+
+    @staticmethod
+    def unpack_ip(addr):
+        if addr.startswith(b"\x00" * 10 + b"\xff\xff"):
+            return socket.inet_ntop(socket.AF_INET, addr[12:])
+        return socket.inet_ntop(socket.AF_INET6, addr)
+
+    def get_addr(self, slot):
+        return bytes(self.addrs[slot * self.ADDR_LEN:(slot + 1) * self.ADDR_LEN])
+
+    def find_index_pos(self, addr):
+        pos = hash(addr) & self.index_mask
+        while True:
+            slot = self.index[pos]
+            if slot == self.EMPTY or self.get_addr(slot) == addr:
+                return pos
+            pos = (pos + 1) & self.index_mask
+
+    def remove_index_pos(self, pos):
+        # backward shift deletion, moves the next entries of the probe chain to the hole
+        self.index[pos] = self.EMPTY
+        next_pos = pos
+        while True:
+            next_pos = (next_pos + 1) & self.index_mask
+            slot = self.index[next_pos]
+            if slot == self.EMPTY:
+                return
+
+            ideal_pos = hash(self.get_addr(slot)) & self.index_mask
+            if (next_pos - ideal_pos) & self.index_mask >= (next_pos - pos) & self.index_mask:
+                self.index[pos] = slot
+                self.index[next_pos] = self.EMPTY
+                pos = next_pos
+
+    def add(self, ip):
+        if self.max_len <= 0:
+            return
+
+        addr = self.pack_ip(ip)
+        if addr is None:
+            return
+
+        pos = self.find_index_pos(addr)
+        if self.index[pos] != self.EMPTY:
+            return
+
+        slot = self.next_slot
+        if self.len == self.max_len:
+            self.remove_index_pos(self.find_index_pos(self.get_addr(slot)))
+            pos = self.find_index_pos(addr)
+        else:
+            self.len += 1
+
+        self.addrs[slot * self.ADDR_LEN:(slot + 1) * self.ADDR_LEN] = addr
+        self.index[pos] = slot
+        self.next_slot = (slot + 1) % self.max_len
+
+        if len(self.new_ips) < self.max_len:
+            self.new_ips.append(addr)
+
+    def __contains__(self, ip):
+        addr = self.pack_ip(ip)
+        if addr is None or self.max_len <= 0:
+            return False
+        return self.index[self.find_index_pos(addr)] != self.EMPTY
+
+    def __len__(self):
+        return self.len
+
+    def pop_new_ips(self):
+        new_ips = [self.unpack_ip(addr) for addr in self.new_ips]
+        self.new_ips = []
+        return new_ips
+
+    def get_mem_size(self):
+        mem_size = len(self.addrs) + len(self.index) * self.index.itemsize
+        return mem_size + len(self.new_ips) * (sys.getsizeof(b"\x00" * self.ADDR_LEN) + 8)
+
+
+def init_client_ips():
+    global client_ips
+
+    # on the config reload keep the ips if the length is the same
+    if client_ips is not None and client_ips.max_len == config.CLIENT_IPS_LEN:
+        return
+
+    client_ips = ClientIPs(config.CLIENT_IPS_LEN)
+
+
+class TgEndpointScore:
+    __slots__ = ("connect_time", "failures", "backoff_until")
+
+    def __init__(self):
+        # zero for the unknown endpoints to try them first
+        self.connect_time = 0.0
+        self.failures = 0
+        self.backoff_until = 0.0
+
+
+class TgEndpointScores:
+    # the better of two random healthy endpoints, the failing ones back off
+    CONNECT_TIME_ALPHA = 0.2
+    MIN_BACKOFF = 1
+    MAX_BACKOFF = 5*60
+    # the ip version is switched from the preferred one if its connects succeed less often
+    FAMILY_SUCCESS_ALPHA = 0.1
+    MIN_FAMILY_SUCCESS = 0.5
+
+    def __init__(self):
+        self.scores = collections.defaultdict(TgEndpointScore)
+        # the average connect success for ipv6 and ipv4 endpoints
+        self.family_success = {True: 1.0, False: 1.0}
+
+    def update_family_success(self, host, success):
+        is_ipv6 = ":" in host
+        alpha = TgEndpointScores.FAMILY_SUCCESS_ALPHA
+        self.family_success[is_ipv6] = (1 - alpha) * self.family_success[is_ipv6] + alpha * success
+
+    def is_ipv6_preferred(self):
+        preferred = bool(config.PREFER_IPV6)
+        if (self.family_success[preferred] < TgEndpointScores.MIN_FAMILY_SUCCESS and
+                self.family_success[not preferred] > self.family_success[preferred]):
+            return not preferred
+        return preferred
+
+    def order_by_family(self, endpoints_v6, endpoints_v4):
+        # the preferred ip version goes first
+        chosen = []
+        if my_ip_info["ipv6"] and endpoints_v6:
+            chosen.append(self.choose(endpoints_v6))
+        if my_ip_info["ipv4"] and endpoints_v4:
+            chosen.append(self.choose(endpoints_v4))
+
+        if not chosen:
+            # the ip info is unknown, try ipv4
+            if endpoints_v4:
+                chosen.append(self.choose(endpoints_v4))
+            elif endpoints_v6:
+                chosen.append(self.choose(endpoints_v6))
+
+        if len(chosen) == 2 and not self.is_ipv6_preferred():
+            chosen.reverse()
+        return chosen
+
+    def add_success(self, host, port, connect_time):
+        self.update_family_success(host, 1)
+
+        score = self.scores[(host, port)]
+        if score.connect_time:
+            alpha = TgEndpointScores.CONNECT_TIME_ALPHA
+            score.connect_time = (1 - alpha) * score.connect_time + alpha * connect_time
+        else:
+            score.connect_time = connect_time
+        score.failures = 0
+        score.backoff_until = 0.0
+
+    def add_failure(self, host, port):
+        self.update_family_success(host, 0)
+
+        score = self.scores[(host, port)]
+        score.failures += 1
+        backoff = TgEndpointScores.MIN_BACKOFF * 2 ** (score.failures - 1)
+        score.backoff_until = time.monotonic() + min(backoff, TgEndpointScores.MAX_BACKOFF)
+
+    def choose(self, endpoints):
+        now = time.monotonic()
+        healthy = [ep for ep in endpoints if self.scores[ep].backoff_until <= now]
+
+        if not healthy:
+            return min(endpoints, key=lambda ep: self.scores[ep].backoff_until)
+        if len(healthy) == 1:
+            return healthy[0]
+
+        first, second = myrandom.sample(healthy, 2)
+        return min(first, second, key=lambda ep: self.scores[ep].connect_time)
+
+
+tg_endpoint_scores = TgEndpointScores()
+
+
+class TgConnectionDemand:
+    # the acquisition rate and the connect time of the pool key
+    __slots__ = ("rate", "rate_time", "connect_time", "last_acquire_time")
+
+    # the initial connect time estimation, seconds
+    INITIAL_CONNECT_TIME = 1
+    CONNECT_TIME_ALPHA = 0.2
+
+    def __init__(self):
+        self.rate = 0.0
+        self.rate_time = self.last_acquire_time = time.monotonic()
+        self.connect_time = TgConnectionDemand.INITIAL_CONNECT_TIME
+
+    def get_rate(self, now):
+        # the exponentially decaying acquisitions count per DEMAND_PERIOD, per second
+        return self.rate * math.exp((self.rate_time - now) / TgConnectionPool.DEMAND_PERIOD)
+
+    def add_acquire(self, now):
+        self.rate = self.get_rate(now) + 1 / TgConnectionPool.DEMAND_PERIOD
+        self.rate_time = self.last_acquire_time = now
+
+    def add_connect_time(self, connect_time):
+        alpha = TgConnectionDemand.CONNECT_TIME_ALPHA
+        self.connect_time = (1 - alpha) * self.connect_time + alpha * connect_time
+
+
+class TgPooledConnection:
+    __slots__ = ("conn", "create_time")
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.create_time = time.monotonic()
+
+    def is_alive(self):
+        reader, writer, *other = self.conn
+        while isinstance(reader, LayeredStreamReaderBase):
+            reader = reader.upstream
+        return not writer.transport.is_closing() and not reader.at_eof()
+
+    def is_fresh(self, now):
+        return now - self.create_time < config.TG_POOL_CONN_MAX_AGE and self.is_alive()
+
+    def close(self):
+        reader, writer, *other = self.conn
+        writer.transport.abort()
+
+
 class TgConnectionPool:
+    # the pool size is the acquisition rate multiplied by the connect time
+    MIN_CONNS_IN_POOL = 1
     MAX_CONNS_IN_POOL = 64
 
+    # the averaging period of the acquisition rate, seconds
+    DEMAND_PERIOD = 30
+    # the pool is this times bigger than the estimation to handle bursts
+    SPARE_FACTOR = 2
+    # the host connections are closed if there were no acquisitions for this time, seconds
+    IDLE_TIMEOUT = 10*60
+    # the delay between the pools maintenance, seconds
+    MAINTAIN_PERIOD = 10
+
     def __init__(self):
-        self.pools = {}
+        # the opened connections, the oldest are given first
+        self.ready_conns = {}
+        # the opening connection tasks, they move their results to ready_conns when done
+        self.pending_conns = {}
+        self.demands = {}
 
     async def open_tg_connection(self, host, port, init_func=None):
+        global tg_endpoint_scores
+
+        start = time.monotonic()
+        try:
+            ret = await self.open_unscored_tg_connection(host, port, init_func)
+        except (OSError, ConnectionAbortedError, asyncio.TimeoutError):
+            tg_endpoint_scores.add_failure(host, port)
+            raise
+
+        tg_endpoint_scores.add_success(host, port, time.monotonic() - start)
+        return ret
+
+    async def open_unscored_tg_connection(self, host, port, init_func=None):
         task = asyncio.open_connection(host, port, limit=get_to_clt_bufsize())
         reader_tgt, writer_tgt = await asyncio.wait_for(task, timeout=config.TG_CONNECT_TIMEOUT)
 
@@ -500,37 +1356,169 @@ class TgConnectionPool:
                                           timeout=config.TG_CONNECT_TIMEOUT)
         return reader_tgt, writer_tgt
 
-    def register_host_port(self, host, port, init_func):
-        if (host, port, init_func) not in self.pools:
-            self.pools[(host, port, init_func)] = []
+    async def open_measured_tg_connection(self, host, port, init_func):
+        start = time.monotonic()
+        ret = await self.open_tg_connection(host, port, init_func)
 
-        while len(self.pools[(host, port, init_func)]) < TgConnectionPool.MAX_CONNS_IN_POOL:
-            connect_task = asyncio.ensure_future(self.open_tg_connection(host, port, init_func))
-            self.pools[(host, port, init_func)].append(connect_task)
+        demand = self.demands.get((host, port, init_func))
+        if demand:
+            demand.add_connect_time(time.monotonic() - start)
+        return ret
 
-    async def get_connection(self, host, port, init_func=None):
-        self.register_host_port(host, port, init_func)
+    def get_target_size(self, key, now):
+        demand = self.demands[key]
+        if now - demand.last_acquire_time > TgConnectionPool.IDLE_TIMEOUT:
+            return 0
 
-        ret = None
-        for task in self.pools[(host, port, init_func)][::]:
-            if task.done():
-                if task.exception():
-                    self.pools[(host, port, init_func)].remove(task)
-                    continue
+        # the connection which is likely to be replaced by age before it is taken is not kept,
+        # so the keys without demand don't make a handshake every TG_POOL_CONN_MAX_AGE
+        rate = demand.get_rate(now)
+        if rate * config.TG_POOL_CONN_MAX_AGE < 1:
+            return 0
 
-                reader, writer, *other = task.result()
-                if writer.transport.is_closing():
-                    self.pools[(host, port, init_func)].remove(task)
-                    continue
+        size = math.ceil(rate * demand.connect_time * TgConnectionPool.SPARE_FACTOR)
+        return min(max(size, TgConnectionPool.MIN_CONNS_IN_POOL), TgConnectionPool.MAX_CONNS_IN_POOL)
+
+    def on_connect_done(self, key, task):
+        self.pending_conns[key].discard(task)
+
+        if task.cancelled() or task.exception():
+            return
+
+        pooled_conn = TgPooledConnection(task.result())
+        if not pooled_conn.is_alive():
+            return
 
-                if not ret:
-                    self.pools[(host, port, init_func)].remove(task)
-                    ret = (reader, writer, *other)
+        if config.TG_POOL_PROBE_INTERVAL:
+            reader, writer, *other = pooled_conn.conn
+            set_keepalive(writer.get_extra_info("socket"), config.TG_POOL_PROBE_INTERVAL, 2)
+        self.ready_conns[key].append(pooled_conn)
 
+    def register_host_port(self, host, port, init_func):
+        key = (host, port, init_func)
+        if key not in self.ready_conns:
+            self.ready_conns[key] = collections.deque()
+            self.pending_conns[key] = set()
+            self.demands[key] = TgConnectionDemand()
+
+    def fill_pool(self, key):
+        host, port, init_func = key
+        ready_conns, pending_conns = self.ready_conns[key], self.pending_conns[key]
+
+        target_size = self.get_target_size(key, time.monotonic())
+        while len(ready_conns) + len(pending_conns) < target_size:
+            connect_task = asyncio.ensure_future(
+                self.open_measured_tg_connection(host, port, init_func))
+            connect_task.add_done_callback(lambda task: self.on_connect_done(key, task))
+            pending_conns.add(connect_task)
+
+    async def get_connection(self, host, port, init_func=None):
+        key = (host, port, init_func)
         self.register_host_port(host, port, init_func)
+        now = time.monotonic()
+        self.demands[key].add_acquire(now)
+
+        ret = None
+        ready_conns = self.ready_conns[key]
+        while ready_conns and not ret:
+            pooled_conn = ready_conns.popleft()
+            if pooled_conn.is_fresh(now):
+                ret = pooled_conn.conn
+            else:
+                pooled_conn.close()
+
+        self.fill_pool(key)
         if ret:
+            if config.TG_POOL_PROBE_INTERVAL:
+                reader, writer, *other = ret
+                set_keepalive(writer.get_extra_info("socket"))
+            update_stats(pool_hits=1)
             return ret
-        return await self.open_tg_connection(host, port, init_func)
+        update_stats(pool_misses=1)
+        return await self.open_measured_tg_connection(host, port, init_func)
+
+    def put_connection(self, host, port, init_func, conn):
+        key = (host, port, init_func)
+        pooled_conn = TgPooledConnection(conn)
+        if key in self.ready_conns and pooled_conn.is_alive():
+            self.ready_conns[key].append(pooled_conn)
+        else:
+            pooled_conn.close()
+
+    async def get_racing_connection(self, endpoints, init_func=None):
+        # the endpoints start HAPPY_EYEBALLS_DELAY apart, the first opened one wins
+        if not config.HAPPY_EYEBALLS_DELAY:
+            endpoints = endpoints[:1]
+
+        tasks = {}
+        pending = set()
+        ret = None
+        error = None
+
+        try:
+            for pos, (host, port) in enumerate(endpoints):
+                task = asyncio.ensure_future(self.get_connection(host, port, init_func))
+                tasks[task] = (host, port)
+                pending.add(task)
+
+                is_last = (pos == len(endpoints) - 1)
+                while pending and not ret:
+                    delay = None if is_last else config.HAPPY_EYEBALLS_DELAY
+                    done, pending = await asyncio.wait(pending, timeout=delay,
+                                                       return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        if task.exception():
+                            error = task.exception()
+                        elif not ret:
+                            ret = task.result()
+
+                    # the next endpoint is started on the delay or when all the tries failed
+                    if not done or (not is_last and not pending):
+                        break
+
+                if ret:
+                    return ret
+
+            raise error
+        finally:
+            for task, (host, port) in tasks.items():
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled() and not task.exception() and task.result() is not ret:
+                    self.put_connection(host, port, init_func, task.result())
+
+    def maintain(self):
+        # replaces the dead and old connections, trims the pools to the target sizes
+        now = time.monotonic()
+        for key, ready_conns in list(self.ready_conns.items()):
+            fresh_conns = []
+            for pooled_conn in ready_conns:
+                if pooled_conn.is_fresh(now):
+                    fresh_conns.append(pooled_conn)
+                else:
+                    pooled_conn.close()
+            ready_conns.clear()
+            ready_conns.extend(fresh_conns)
+
+            target_size = self.get_target_size(key, now)
+            while ready_conns and len(ready_conns) + len(self.pending_conns[key]) > target_size:
+                ready_conns.popleft().close()
+
+            # the pending connections are waited to be sure their callbacks find the key
+            if not ready_conns and not self.pending_conns[key] and target_size == 0:
+                del self.ready_conns[key]
+                del self.pending_conns[key]
+                del self.demands[key]
+            else:
+                self.fill_pool(key)
+
+    def get_warm_counts(self):
+        now = time.monotonic()
+        counts = {}
+        for key, ready_conns in self.ready_conns.items():
+            ready_count = sum(1 for pooled_conn in ready_conns if pooled_conn.is_alive())
+            counts[key] = (ready_count, self.get_target_size(key, now))
+        return counts
 
 
 tg_connection_pool = TgConnectionPool()
@@ -579,17 +1567,21 @@ class LayeredStreamWriterBase:
 
 
 class FakeTLSStreamReader(LayeredStreamReaderBase):
-    __slots__ = ('buf', )
+    __slots__ = ('buf', 'buf_pos')
 
     def __init__(self, upstream):
         self.upstream = upstream
+        # the data before buf_pos is already read, it is dropped only when the new data comes
+        # so the small reads don't copy the rest of the buffer
         self.buf = bytearray()
+        self.buf_pos = 0
 
     async def read(self, n, ignore_buf=False):
-        if self.buf and not ignore_buf:
-            data = self.buf
-            self.buf = bytearray()
-            return bytes(data)
+        if len(self.buf) > self.buf_pos and not ignore_buf:
+            data = bytes(self.buf[self.buf_pos:])
+            self.buf.clear()
+            self.buf_pos = 0
+            return data
 
         while True:
             tls_rec_type = await self.upstream.readexactly(1)
@@ -612,13 +1604,17 @@ class FakeTLSStreamReader(LayeredStreamReaderBase):
             return data
 
     async def readexactly(self, n):
-        while len(self.buf) < n:
+        while len(self.buf) - self.buf_pos < n:
             tls_data = await self.read(1, ignore_buf=True)
             if not tls_data:
                 return b""
+            del self.buf[:self.buf_pos]
+            self.buf_pos = 0
             self.buf += tls_data
-        data, self.buf = self.buf[:n], self.buf[n:]
-        return bytes(data)
+
+        pos = self.buf_pos
+        self.buf_pos += n
+        return bytes(self.buf[pos:pos+n])
 
 
 class FakeTLSStreamWriter(LayeredStreamWriterBase):
@@ -629,26 +1625,62 @@ class FakeTLSStreamWriter(LayeredStreamWriterBase):
 
     def write(self, data, extra={}):
         MAX_CHUNK_SIZE = 16384 + 24
+
+        # the records are joined to pass them to the upstream with one write
+        records = []
+        data_view = memoryview(data)
         for start in range(0, len(data), MAX_CHUNK_SIZE):
             end = min(start+MAX_CHUNK_SIZE, len(data))
-            self.upstream.write(b"\x17\x03\x03" + int.to_bytes(end-start, 2, "big"))
-            self.upstream.write(data[start: end])
+            records.append(b"\x17\x03\x03" + int.to_bytes(end-start, 2, "big"))
+            records.append(data_view[start:end])
+        if records:
+            self.upstream.write(b"".join(records))
         return len(data)
 
 
+def get_stream_buffer(stream):
+    # the private attribute, trusted only on the known python versions
+    MIN_KNOWN_VERSION = (3, 6)
+    MAX_KNOWN_VERSION = (3, 14)
+
+    if not MIN_KNOWN_VERSION <= sys.version_info[:2] <= MAX_KNOWN_VERSION:
+        return None
+    if not isinstance(stream, asyncio.StreamReader):
+        return None
+
+    buf = getattr(stream, "_buffer", None)
+    if not isinstance(buf, bytearray):
+        return None
+    return buf
+
+
+def get_stream_buffered_len(stream):
+    if isinstance(stream, FakeTLSStreamReader):
+        return len(stream.buf) - stream.buf_pos
+
+    buf = get_stream_buffer(stream)
+    if buf is None:
+        return 0
+    return len(buf)
+
+
 class CryptoWrappedStreamReader(LayeredStreamReaderBase):
-    __slots__ = ('decryptor', 'block_size', 'buf')
+    __slots__ = ('decryptor', 'block_size', 'buf', 'buf_pos', 'decrypt_calls')
 
     def __init__(self, upstream, decryptor, block_size=1):
         self.upstream = upstream
         self.decryptor = decryptor
         self.block_size = block_size
+        # the data before buf_pos is already read, see FakeTLSStreamReader
         self.buf = bytearray()
+        self.buf_pos = 0
+        self.decrypt_calls = 0
 
     async def read(self, n):
-        if self.buf:
-            ret = bytes(self.buf)
+        if len(self.buf) > self.buf_pos:
+            ret = bytes(self.buf[self.buf_pos:])
             self.buf.clear()
+            self.buf_pos = 0
             return ret
         else:
             data = await self.upstream.read(n)
@@ -658,37 +1690,110 @@ class CryptoWrappedStreamReader(LayeredStreamReaderBase):
             needed_till_full_block = -len(data) % self.block_size
             if needed_till_full_block > 0:
                 data += await self.upstream.readexactly(needed_till_full_block)
+            self.decrypt_calls += 1
             return self.decryptor.decrypt(data)
 
     async def readexactly(self, n):
-        if n > len(self.buf):
-            to_read = n - len(self.buf)
+        if n > len(self.buf) - self.buf_pos:
+            to_read = n - (len(self.buf) - self.buf_pos)
             needed_till_full_block = -to_read % self.block_size
 
             to_read_block_aligned = to_read + needed_till_full_block
+
+            # all the ciphertext already buffered by the upstream is decrypted with one call,
+            # so the next small reads of the frame readers don't call the decryptor
+            buffered_len = get_stream_buffered_len(self.upstream)
+            buffered_len -= buffered_len % self.block_size
+            to_read_block_aligned = max(to_read_block_aligned, buffered_len)
+
             data = await self.upstream.readexactly(to_read_block_aligned)
+            self.decrypt_calls += 1
+            del self.buf[:self.buf_pos]
+            self.buf_pos = 0
             self.buf += self.decryptor.decrypt(data)
 
-        ret = bytes(self.buf[:n])
-        self.buf = self.buf[n:]
-        return ret
+        pos = self.buf_pos
+        self.buf_pos += n
+        return bytes(self.buf[pos:pos+n])
 
 
 class CryptoWrappedStreamWriter(LayeredStreamWriterBase):
-    __slots__ = ('encryptor', 'block_size')
+    # the writes of one loop iteration are encrypted and written together
+    __slots__ = ('encryptor', 'block_size', 'corked', 'corked_len', 'flush_handle')
+
+    MAX_CORKED_LEN = 65536
 
     def __init__(self, upstream, encryptor, block_size=1):
         self.upstream = upstream
         self.encryptor = encryptor
         self.block_size = block_size
+        self.corked = []
+        self.corked_len = 0
+        self.flush_handle = None
 
     def write(self, data, extra={}):
         if len(data) % self.block_size != 0:
             print_err("BUG: writing %d bytes not aligned to block size %d" % (
                       len(data), self.block_size))
             return 0
-        q = self.encryptor.encrypt(data)
-        return self.upstream.write(q)
+
+        self.corked.append(data)
+        self.corked_len += len(data)
+        if self.corked_len >= self.MAX_CORKED_LEN:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = asyncio.get_event_loop().call_soon(self.flush)
+        return len(data)
+
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+
+        if not self.corked:
+            return
+
+        if len(self.corked) == 1:
+            data = self.corked[0]
+        else:
+            data = b"".join(self.corked)
+        self.corked = []
+        self.corked_len = 0
+
+        # the connection can be aborted below this layer, the corked data is dropped then
+        if self.upstream.transport.is_closing():
+            return
+
+        self.upstream.write(self.encryptor.encrypt(data))
+
+    def write_eof(self):
+        self.flush()
+        return self.upstream.write_eof()
+
+    async def drain(self):
+        self.flush()
+        return await self.upstream.drain()
+
+    def close(self):
+        self.flush()
+        return self.upstream.close()
+
+    def abort(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        self.corked = []
+        self.corked_len = 0
+        return self.upstream.transport.abort()
+
+
+def get_corking_writer(writer):
+    # the crypto layer keeps the corked data out of the transport
+    while writer is not None:
+        if isinstance(writer, CryptoWrappedStreamWriter):
+            return writer
+        writer = getattr(writer, "upstream", None)
+    return None
 
 
 class MTProtoFrameStreamReader(LayeredStreamReaderBase):
@@ -750,27 +1855,171 @@ class MTProtoFrameStreamWriter(LayeredStreamWriterBase):
         return self.upstream.write(full_msg + padding)
 
 
-class MTProtoCompactFrameStreamReader(LayeredStreamReaderBase):
+class MTProtoFrameDecoderBase:
+    # the sans-io decoder, feed returns the (memoryview, flags) of the completed frames
+    __slots__ = ('buf', 'needed_len', 'closed')
+
+    # the subclasses define parse(data), it returns the frames, the position after them
+    # and the length needed for the next frame
+
+    def __init__(self):
+        # the incomplete frame and the length it needs to be parsed
+        self.buf = bytearray()
+        self.needed_len = 0
+        # the empty frame closes the connection, like the eof
+        self.closed = False
+
+    def feed(self, data):
+        if self.closed:
+            return []
+
+        if self.buf:
+            self.buf += data
+            if len(self.buf) < self.needed_len:
+                return []
+            data = bytes(self.buf)
+            self.buf.clear()
+        elif not isinstance(data, bytes):
+            data = bytes(data)
+
+        frames, pos, self.needed_len = self.parse(memoryview(data))
+        if pos < len(data) and not self.closed:
+            self.buf += data[pos:]
+        return frames
+
+
+class MTProtoCompactFrameDecoder(MTProtoFrameDecoderBase):
     __slots__ = ()
 
+    def parse(self, data):
+        frames = []
+        pos, data_len = 0, len(data)
+
+        while pos < data_len:
+            msg_len = data[pos]
+
+            flags = 0
+            if msg_len >= 0x80:
+                flags = FRAME_FLAG_QUICKACK
+                msg_len -= 0x80
+
+            header_len = 1
+            if msg_len == 0x7f:
+                header_len = 4
+                if pos + header_len > data_len:
+                    return frames, pos, header_len
+                msg_len = int.from_bytes(data[pos+1:pos+4], "little")
+
+            msg_len *= 4
+
+            if pos + header_len + msg_len > data_len:
+                return frames, pos, header_len + msg_len
+            if msg_len == 0:
+                self.closed = True
+                return frames, pos, 0
+
+            msg_pos = pos + header_len
+            pos = msg_pos + msg_len
+            frames.append((data[msg_pos:pos], flags))
+
+        return frames, pos, 0
+
+
+class MTProtoIntermediateFrameDecoder(MTProtoFrameDecoderBase):
+    __slots__ = ()
+
+    # the secure intermediate frames have the random padding, it is cut
+    CUT_PADDING = False
+
+    def parse(self, data):
+        HEADER_LEN = 4
+
+        frames = []
+        pos, data_len = 0, len(data)
+
+        while pos < data_len:
+            if pos + HEADER_LEN > data_len:
+                return frames, pos, HEADER_LEN
+            msg_len = int.from_bytes(data[pos:pos+HEADER_LEN], "little")
+
+            flags = 0
+            if msg_len > 0x80000000:
+                flags = FRAME_FLAG_QUICKACK
+                msg_len -= 0x80000000
+
+            if pos + HEADER_LEN + msg_len > data_len:
+                return frames, pos, HEADER_LEN + msg_len
+
+            msg_pos = pos + HEADER_LEN
+            pos = msg_pos + msg_len
+
+            if self.CUT_PADDING:
+                msg_len -= msg_len % 4
+            if msg_len == 0:
+                self.closed = True
+                return frames, pos, 0
+
+            frames.append((data[msg_pos:msg_pos+msg_len], flags))
+
+        return frames, pos, 0
+
+
+class MTProtoSecureIntermediateFrameDecoder(MTProtoIntermediateFrameDecoder):
+    __slots__ = ()
+
+    CUT_PADDING = True
+
+
+class MTProtoFrameBatchStreamReader(LayeredStreamReaderBase):
+    # the frames which came together are returned by one read_batch
+    __slots__ = ('decoder', 'frames', 'frames_pos')
+
+    # the subclasses set DECODER to the decoder class of their protocol
+
+    def __init__(self, upstream):
+        self.upstream = upstream
+        self.decoder = self.DECODER()
+        # the batch which is returned frame by frame by the read
+        self.frames = []
+        self.frames_pos = 0
+
+    async def read_batch(self, buf_size):
+        # the empty list means the eof
+        if self.frames_pos < len(self.frames):
+            frames = self.frames[self.frames_pos:]
+            self.frames = []
+            self.frames_pos = 0
+            return frames
+
+        while not self.decoder.closed:
+            data = await self.upstream.read(buf_size)
+            if not data:
+                break
+            frames = self.decoder.feed(data)
+            if frames:
+                return frames
+        return []
+
     async def read(self, buf_size):
-        msg_len_bytes = await self.upstream.readexactly(1)
-        msg_len = int.from_bytes(msg_len_bytes, "little")
+        if self.frames_pos >= len(self.frames):
+            self.frames = await self.read_batch(buf_size)
+            self.frames_pos = 0
+            if not self.frames:
+                return b""
 
-        extra = {"QUICKACK_FLAG": False}
-        if msg_len >= 0x80:
-            extra["QUICKACK_FLAG"] = True
-            msg_len -= 0x80
+        msg, flags = self.frames[self.frames_pos]
+        self.frames_pos += 1
 
-        if msg_len == 0x7f:
-            msg_len_bytes = await self.upstream.readexactly(3)
-            msg_len = int.from_bytes(msg_len_bytes, "little")
+        extra = {}
+        if flags & FRAME_FLAG_QUICKACK:
+            extra["QUICKACK_FLAG"] = True
+        return bytes(msg), extra
 
-        msg_len *= 4
 
-        data = await self.upstream.readexactly(msg_len)
+class MTProtoCompactFrameStreamReader(MTProtoFrameBatchStreamReader):
+    __slots__ = ()
 
-        return data, extra
+    DECODER = MTProtoCompactFrameDecoder
 
 
 class MTProtoCompactFrameStreamWriter(LayeredStreamWriterBase):
@@ -798,20 +2047,10 @@ class MTProtoCompactFrameStreamWriter(LayeredStreamWriterBase):
             return 0
 
 
-class MTProtoIntermediateFrameStreamReader(LayeredStreamReaderBase):
+class MTProtoIntermediateFrameStreamReader(MTProtoFrameBatchStreamReader):
     __slots__ = ()
 
-    async def read(self, buf_size):
-        msg_len_bytes = await self.upstream.readexactly(4)
-        msg_len = int.from_bytes(msg_len_bytes, "little")
-
-        extra = {}
-        if msg_len > 0x80000000:
-            extra["QUICKACK_FLAG"] = True
-            msg_len -= 0x80000000
-
-        data = await self.upstream.readexactly(msg_len)
-        return data, extra
+    DECODER = MTProtoIntermediateFrameDecoder
 
 
 class MTProtoIntermediateFrameStreamWriter(LayeredStreamWriterBase):
@@ -824,25 +2063,10 @@ class MTProtoIntermediateFrameStreamWriter(LayeredStreamWriterBase):
             return self.upstream.write(int.to_bytes(len(data), 4, 'little') + data)
 
 
-class MTProtoSecureIntermediateFrameStreamReader(LayeredStreamReaderBase):
+class MTProtoSecureIntermediateFrameStreamReader(MTProtoFrameBatchStreamReader):
     __slots__ = ()
 
-    async def read(self, buf_size):
-        msg_len_bytes = await self.upstream.readexactly(4)
-        msg_len = int.from_bytes(msg_len_bytes, "little")
-
-        extra = {}
-        if msg_len > 0x80000000:
-            extra["QUICKACK_FLAG"] = True
-            msg_len -= 0x80000000
-
-        data = await self.upstream.readexactly(msg_len)
-
-        if msg_len % 4 != 0:
-            cut_border = msg_len - (msg_len % 4)
-            data = data[:cut_border]
-
-        return data, extra
+    DECODER = MTProtoSecureIntermediateFrameDecoder
 
 
 class MTProtoSecureIntermediateFrameStreamWriter(LayeredStreamWriterBase):
@@ -863,34 +2087,40 @@ class MTProtoSecureIntermediateFrameStreamWriter(LayeredStreamWriterBase):
 class ProxyReqStreamReader(LayeredStreamReaderBase):
     __slots__ = ()
 
-    async def read(self, msg):
+    @staticmethod
+    def parse_ans(data):
+        # the None conn id is for all the clients
         RPC_PROXY_ANS = b"\x0d\xda\x03\x44"
         RPC_CLOSE_EXT = b"\xa2\x34\xb6\x5e"
         RPC_SIMPLE_ACK = b"\x9b\x40\xac\x3b"
         RPC_UNKNOWN = b'\xdf\xa2\x30\x57'
 
-        data = await self.upstream.read(1)
-
         if len(data) < 4:
-            return b""
+            return None, b""
 
         ans_type = data[:4]
         if ans_type == RPC_CLOSE_EXT:
-            return b""
+            conn_id = data[4:12]
+            return conn_id, b""
 
         if ans_type == RPC_PROXY_ANS:
             ans_flags, conn_id, conn_data = data[4:8], data[8:16], data[16:]
-            return conn_data
+            return conn_id, conn_data
 
         if ans_type == RPC_SIMPLE_ACK:
             conn_id, confirm = data[4:12], data[12:16]
-            return confirm, {"SIMPLE_ACK": True}
+            return conn_id, (confirm, {"SIMPLE_ACK": True})
 
         if ans_type == RPC_UNKNOWN:
-            return b"", {"SKIP_SEND": True}
+            return None, (b"", {"SKIP_SEND": True})
 
         print_err("unknown rpc ans type:", ans_type)
-        return b"", {"SKIP_SEND": True}
+        return None, (b"", {"SKIP_SEND": True})
+
+    async def read(self, msg):
+        data = await self.upstream.read(1)
+        conn_id, ans = self.parse_ans(data)
+        return ans
 
 
 class ProxyReqStreamWriter(LayeredStreamWriterBase):
@@ -917,10 +2147,16 @@ class ProxyReqStreamWriter(LayeredStreamWriterBase):
         self.proto_tag = proto_tag
 
     def write(self, msg, extra={}):
+        flags = FRAME_FLAG_QUICKACK if extra.get("QUICKACK_FLAG") else 0
+        return self.write_batch([(msg, flags)])
+
+    def write_batch(self, frames):
+        # returns the count of the rpc requests
         RPC_PROXY_REQ = b"\xee\xf1\xce\x36"
         EXTRA_SIZE = b"\x18\x00\x00\x00"
         PROXY_TAG = b"\xae\x26\x1e\xdb"
         FOUR_BYTES_ALIGNER = b"\x00\x00\x00"
+        NOT_ENCRYPTED_PREFIX = b"\x00" * 8
 
         FLAG_NOT_ENCRYPTED = 0x2
         FLAG_HAS_AD_TAG = 0x8
@@ -931,32 +2167,215 @@ class ProxyReqStreamWriter(LayeredStreamWriterBase):
         FLAG_ABRIDGED = 0x40000000
         FLAG_QUICKACK = 0x80000000
 
-        if len(msg) % 4 != 0:
-            print_err("BUG: attempted to send msg with len %d" % len(msg))
-            return 0
-
-        flags = FLAG_HAS_AD_TAG | FLAG_MAGIC | FLAG_EXTMODE2
+        req_flags = FLAG_HAS_AD_TAG | FLAG_MAGIC | FLAG_EXTMODE2
 
         if self.proto_tag == PROTO_TAG_ABRIDGED:
-            flags |= FLAG_ABRIDGED
+            req_flags |= FLAG_ABRIDGED
         elif self.proto_tag == PROTO_TAG_INTERMEDIATE:
-            flags |= FLAG_INTERMEDIATE
+            req_flags |= FLAG_INTERMEDIATE
         elif self.proto_tag == PROTO_TAG_SECURE:
-            flags |= FLAG_INTERMEDIATE | FLAG_PAD
+            req_flags |= FLAG_INTERMEDIATE | FLAG_PAD
+
+        # the part of the request after the flags is the same for all the frames
+        req_tail = bytearray()
+        req_tail += self.out_conn_id + self.remote_ip_port + self.our_ip_port
+        req_tail += EXTRA_SIZE + PROXY_TAG
+        req_tail += bytes([len(config.AD_TAG)]) + config.AD_TAG + FOUR_BYTES_ALIGNER
+
+        reqs_count = 0
+        for msg, msg_flags in frames:
+            if len(msg) % 4 != 0:
+                print_err("BUG: attempted to send msg with len %d" % len(msg))
+                continue
+
+            flags = req_flags
+            if msg_flags & FRAME_FLAG_QUICKACK:
+                flags |= FLAG_QUICKACK
+
+            if msg[:8] == NOT_ENCRYPTED_PREFIX:
+                flags |= FLAG_NOT_ENCRYPTED
+
+            full_msg = bytearray(RPC_PROXY_REQ)
+            full_msg += int.to_bytes(flags, 4, "little")
+            full_msg += req_tail
+            full_msg += msg
+
+            self.upstream.write(full_msg)
+            reqs_count += 1
+        return reqs_count
+
+
+class MiddleProxyMuxStreamReader(LayeredStreamReaderBase):
+    __slots__ = ('mux', 'queue', 'queued_bytes')
+
+    def __init__(self, mux):
+        self.upstream = None
+        self.mux = mux
+        self.queue = asyncio.Queue()
+        self.queued_bytes = 0
+
+    def put_ans(self, ans):
+        data = ans[0] if isinstance(ans, tuple) else ans
+        self.queued_bytes += len(data)
+        self.mux.queued_bytes += len(data)
+        self.queue.put_nowait(ans)
+
+    def drop_queued(self):
+        # frees the budget of the answers which will never be read
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.mux.free_budget(self.queued_bytes)
+        self.queued_bytes = 0
+
+    async def read(self, n):
+        ans = await self.queue.get()
+        data = ans[0] if isinstance(ans, tuple) else ans
+        self.queued_bytes -= len(data)
+        self.mux.free_budget(len(data))
+        return ans
 
-        if extra.get("QUICKACK_FLAG"):
-            flags |= FLAG_QUICKACK
 
-        if msg.startswith(b"\x00" * 8):
-            flags |= FLAG_NOT_ENCRYPTED
+class MiddleProxyMuxStreamWriter(ProxyReqStreamWriter):
+    __slots__ = ('mux', 'reader')
+
+    def __init__(self, mux, reader, cl_ip, cl_port, proto_tag):
+        super().__init__(mux.writer, cl_ip, cl_port, mux.my_ip, mux.my_port, proto_tag)
+        self.mux = mux
+        self.reader = reader
+
+    def write_batch(self, frames):
+        if self.out_conn_id not in self.mux.clients:
+            return 0
+        return super().write_batch(frames)
+
+    def write_eof(self):
+        self.mux.remove_client(self.out_conn_id)
+
+    async def drain(self):
+        # the older pythons allow only one coroutine to wait for the drain
+        async with self.mux.drain_lock:
+            return await self.upstream.drain()
+
+    def close(self):
+        self.mux.remove_client(self.out_conn_id)
+        self.reader.drop_queued()
+
+    def abort(self):
+        self.mux.remove_client(self.out_conn_id)
+        self.reader.drop_queued()
+
+
+class MiddleProxyMux:
+    # the client answers are routed by conn_id and share one byte budget
+    MAX_QUEUED_BYTES = 2 ** 24
+
+    def __init__(self, reader, writer, my_ip, my_port):
+        self.reader = reader
+        self.writer = writer
+        self.my_ip = my_ip
+        self.my_port = my_port
+
+        self.clients = {}
+        self.drain_lock = asyncio.Lock()
+        self.queued_bytes = 0
+        self.budget_freed = asyncio.Event()
+        self.read_task = asyncio.ensure_future(self.read_answers())
+
+    def is_alive(self):
+        return not self.read_task.done() and not self.writer.transport.is_closing()
+
+    def add_client(self, cl_ip, cl_port, proto_tag):
+        reader = MiddleProxyMuxStreamReader(self)
+        writer = MiddleProxyMuxStreamWriter(self, reader, cl_ip, cl_port, proto_tag)
+        while writer.out_conn_id in self.clients:
+            writer.out_conn_id = myrandom.getrandbytes(8)
+        self.clients[writer.out_conn_id] = reader
+        return reader, writer
+
+    def remove_client(self, conn_id, notify_proxy=True):
+        RPC_CLOSE_CONN = b"\x5d\x42\xcf\x1f"
+
+        reader = self.clients.pop(conn_id, None)
+        if reader is None:
+            return
+
+        reader.put_ans(b"")
+        if notify_proxy and self.is_alive():
+            self.writer.write(RPC_CLOSE_CONN + conn_id)
+
+    def free_budget(self, octets):
+        self.queued_bytes -= octets
+        if self.queued_bytes <= MiddleProxyMux.MAX_QUEUED_BYTES:
+            self.budget_freed.set()
+
+    async def wait_for_budget(self):
+        # the client holding the most of the budget is dropped, so it can't block the others
+        while self.queued_bytes > MiddleProxyMux.MAX_QUEUED_BYTES:
+            if self.clients:
+                conn_id = max(self.clients, key=lambda conn_id: self.clients[conn_id].queued_bytes)
+                reader = self.clients[conn_id]
+                if reader.queued_bytes > MiddleProxyMux.MAX_QUEUED_BYTES // 2:
+                    reader.drop_queued()
+                    self.remove_client(conn_id)
+                    continue
+
+            self.budget_freed.clear()
+            await self.budget_freed.wait()
+
+    async def read_answers(self):
+        try:
+            while True:
+                data = await self.reader.read(get_to_clt_bufsize())
+                if not data:
+                    break
+
+                conn_id, ans = ProxyReqStreamReader.parse_ans(data)
+                reader = self.clients.get(conn_id)
+                if reader is None:
+                    continue
+
+                if ans == b"":
+                    self.remove_client(conn_id, notify_proxy=False)
+                else:
+                    reader.put_ans(ans)
+                    if self.queued_bytes > MiddleProxyMux.MAX_QUEUED_BYTES:
+                        await self.wait_for_budget()
+        except (OSError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.writer.transport.abort()
+            for conn_id in list(self.clients):
+                self.remove_client(conn_id, notify_proxy=False)
+
+
+class MiddleProxyMuxPool:
+    def __init__(self):
+        self.muxes = {}
 
-        full_msg = bytearray()
-        full_msg += RPC_PROXY_REQ + int.to_bytes(flags, 4, "little") + self.out_conn_id
-        full_msg += self.remote_ip_port + self.our_ip_port + EXTRA_SIZE + PROXY_TAG
-        full_msg += bytes([len(config.AD_TAG)]) + config.AD_TAG + FOUR_BYTES_ALIGNER
-        full_msg += msg
+    async def open_mux(self, endpoints):
+        global tg_connection_pool
 
-        return self.upstream.write(full_msg)
+        ret = await tg_connection_pool.get_racing_connection(endpoints, middleproxy_handshake)
+        return MiddleProxyMux(*ret)
+
+    async def get_mux(self, dc_idx, endpoints):
+        muxes = self.muxes.setdefault(dc_idx, [])
+
+        # the failed and closed connections are replaced with new ones
+        muxes[:] = [task for task in muxes if not task.done() or
+                    (not task.cancelled() and not task.exception() and task.result().is_alive())]
+        if len(muxes) < config.MIDDLE_PROXY_MUX_CONNS:
+            muxes.append(asyncio.ensure_future(self.open_mux(endpoints)))
+
+        ready_muxes = [task.result() for task in muxes if task.done()]
+        if ready_muxes:
+            return min(ready_muxes, key=lambda mux: len(mux.clients))
+
+        # the connection is shared, so the client cancellation must not cancel it
+        return await asyncio.shield(muxes[-1])
+
+
+middle_proxy_mux_pool = MiddleProxyMuxPool()
 
 
 def try_setsockopt(sock, level, option, value):
@@ -1081,17 +2500,53 @@ async def handle_bad_client(reader_clt, writer_clt, handshake):
             writer_srv.transport.abort()
 
 
+def find_fake_tls_user(handshake, peer):
+    # None if no user secret signed the client hello
+    global last_clients_with_time_skew
+
+    TIME_SKEW_MIN = -20 * 60
+    TIME_SKEW_MAX = 10 * 60
+
+    DIGEST_LEN = 32
+    DIGEST_POS = 11
+    TIMESTAMP_MASK = 0xffffffff
+
+    digest = handshake[DIGEST_POS:DIGEST_POS+DIGEST_LEN]
+    digest_int = int.from_bytes(digest, "big")
+
+    msg = handshake[:DIGEST_POS] + b"\x00"*DIGEST_LEN + handshake[DIGEST_POS+DIGEST_LEN:]
+
+    for user, secret, secret_hmac in user_secrets:
+        msg_hmac = secret_hmac.copy()
+        msg_hmac.update(msg)
+        xored_digest = digest_int ^ int.from_bytes(msg_hmac.digest(), "big")
+
+        # all the bytes except the last four with the timestamp should be zero
+        if xored_digest > TIMESTAMP_MASK:
+            continue
+
+        timestamp = int.from_bytes(int.to_bytes(xored_digest, 4, "big"), "little")
+        client_time_is_ok = TIME_SKEW_MIN < time.time() - timestamp < TIME_SKEW_MAX
+
+        # some clients fail to read unix time and send the time since boot instead
+        client_time_is_small = timestamp < 60*60*24*1000
+        accept_bad_time = config.IGNORE_TIME_SKEW or is_time_skewed or client_time_is_small
+
+        if not client_time_is_ok and not accept_bad_time:
+            last_clients_with_time_skew[peer[0]] = (time.time() - timestamp) // 60
+            continue
+
+        return user, secret, secret_hmac
+
+    return None
+
+
 async def handle_fake_tls_handshake(handshake, reader, writer, peer):
     global used_handshakes
     global client_ips
-    global last_client_ips
-    global last_clients_with_time_skew
     global last_clients_with_same_handshake
     global fake_cert_len
 
-    TIME_SKEW_MIN = -20 * 60
-    TIME_SKEW_MAX = 10 * 60
-
     TLS_VERS = b"\x03\x03"
     TLS_CIPHERSUITE = b"\x13\x01"
     TLS_CHANGE_CIPHER = b"\x14" + TLS_VERS + b"\x00\x01\x01"
@@ -1116,62 +2571,37 @@ async def handle_fake_tls_handshake(handshake, reader, writer, peer):
     sess_id_len = handshake[SESSION_ID_LEN_POS]
     sess_id = handshake[SESSION_ID_POS:SESSION_ID_POS+sess_id_len]
 
-    for user in config.USERS:
-        secret = bytes.fromhex(config.USERS[user])
-
-        msg = handshake[:DIGEST_POS] + b"\x00"*DIGEST_LEN + handshake[DIGEST_POS+DIGEST_LEN:]
-        computed_digest = hmac.new(secret, msg, digestmod=hashlib.sha256).digest()
-
-        xored_digest = bytes(digest[i] ^ computed_digest[i] for i in range(DIGEST_LEN))
-        digest_good = xored_digest.startswith(b"\x00" * (DIGEST_LEN-4))
-
-        if not digest_good:
-            continue
-
-        timestamp = int.from_bytes(xored_digest[-4:], "little")
-        client_time_is_ok = TIME_SKEW_MIN < time.time() - timestamp < TIME_SKEW_MAX
-
-        # some clients fail to read unix time and send the time since boot instead
-        client_time_is_small = timestamp < 60*60*24*1000
-        accept_bad_time = config.IGNORE_TIME_SKEW or is_time_skewed or client_time_is_small
-
-        if not client_time_is_ok and not accept_bad_time:
-            last_clients_with_time_skew[peer[0]] = (time.time() - timestamp) // 60
-            continue
-
-        http_data = myrandom.getrandbytes(fake_cert_len)
+    user_data = find_fake_tls_user(handshake, peer)
+    if not user_data:
+        return False
 
-        srv_hello = TLS_VERS + b"\x00"*DIGEST_LEN + bytes([sess_id_len]) + sess_id
-        srv_hello += TLS_CIPHERSUITE + b"\x00" + tls_extensions
+    user, secret, secret_hmac = user_data
 
-        hello_pkt = b"\x16" + TLS_VERS + int.to_bytes(len(srv_hello) + 4, 2, "big")
-        hello_pkt += b"\x02" + int.to_bytes(len(srv_hello), 3, "big") + srv_hello
-        hello_pkt += TLS_CHANGE_CIPHER + TLS_APP_HTTP2_HDR
-        hello_pkt += int.to_bytes(len(http_data), 2, "big") + http_data
+    http_data = myrandom.getrandbytes(fake_cert_len)
 
-        computed_digest = hmac.new(secret, msg=digest+hello_pkt, digestmod=hashlib.sha256).digest()
-        hello_pkt = hello_pkt[:DIGEST_POS] + computed_digest + hello_pkt[DIGEST_POS+DIGEST_LEN:]
+    srv_hello = TLS_VERS + b"\x00"*DIGEST_LEN + bytes([sess_id_len]) + sess_id
+    srv_hello += TLS_CIPHERSUITE + b"\x00" + tls_extensions
 
-        writer.write(hello_pkt)
-        await writer.drain()
+    hello_pkt = b"\x16" + TLS_VERS + int.to_bytes(len(srv_hello) + 4, 2, "big")
+    hello_pkt += b"\x02" + int.to_bytes(len(srv_hello), 3, "big") + srv_hello
+    hello_pkt += TLS_CHANGE_CIPHER + TLS_APP_HTTP2_HDR
+    hello_pkt += int.to_bytes(len(http_data), 2, "big") + http_data
 
-        if config.REPLAY_CHECK_LEN > 0:
-            while len(used_handshakes) >= config.REPLAY_CHECK_LEN:
-                used_handshakes.popitem(last=False)
-            used_handshakes[digest[:DIGEST_HALFLEN]] = True
+    hello_hmac = secret_hmac.copy()
+    hello_hmac.update(digest + hello_pkt)
+    computed_digest = hello_hmac.digest()
+    hello_pkt = hello_pkt[:DIGEST_POS] + computed_digest + hello_pkt[DIGEST_POS+DIGEST_LEN:]
 
-        if config.CLIENT_IPS_LEN > 0:
-            while len(client_ips) >= config.CLIENT_IPS_LEN:
-                client_ips.popitem(last=False)
-            if peer[0] not in client_ips:
-                client_ips[peer[0]] = True
-                last_client_ips[peer[0]] = True
+    writer.write(hello_pkt)
+    await writer.drain()
 
-        reader = FakeTLSStreamReader(reader)
-        writer = FakeTLSStreamWriter(writer)
-        return reader, writer
+    used_handshakes.add(digest[:DIGEST_HALFLEN])
 
-    return False
+    client_ips.add(peer[0])
+
+    reader = FakeTLSStreamReader(reader)
+    writer = FakeTLSStreamWriter(writer)
+    return reader, writer
 
 
 async def handle_proxy_protocol(reader, peer=None):
@@ -1229,10 +2659,60 @@ async def handle_proxy_protocol(reader, peer=None):
     return False
 
 
+def find_handshake_user(handshake, is_tls_handshake):
+    # the proto tag and dc idx are in the last block, only this block is decrypted for each user
+    # after that the decryptor is right at the end of the handshake, ready for the client data
+    TAG_BLOCK_POS = PROTO_TAG_POS - PROTO_TAG_POS % 16
+    TAG_BLOCK_NUM = TAG_BLOCK_POS // 16
+    MAX_IV = 2 ** 128
+
+    dec_prekey_and_iv = handshake[SKIP_LEN:SKIP_LEN+PREKEY_LEN+IV_LEN]
+    dec_prekey, dec_iv = dec_prekey_and_iv[:PREKEY_LEN], dec_prekey_and_iv[PREKEY_LEN:]
+    enc_prekey_and_iv = dec_prekey_and_iv[::-1]
+    enc_prekey, enc_iv = enc_prekey_and_iv[:PREKEY_LEN], enc_prekey_and_iv[PREKEY_LEN:]
+
+    dec_iv_int = int.from_bytes(dec_iv, "big")
+    tag_block_iv = (dec_iv_int + TAG_BLOCK_NUM) % MAX_IV
+    tag_block = handshake[TAG_BLOCK_POS:TAG_BLOCK_POS+16]
+
+    # the prekey is the same for all users, so hash it only once
+    dec_prekey_hash = hashlib.sha256(dec_prekey)
+
+    for user, secret, secret_hmac in user_secrets:
+        dec_key_hash = dec_prekey_hash.copy()
+        dec_key_hash.update(secret)
+        dec_key = dec_key_hash.digest()
+
+        decryptor = create_aes_ctr(key=dec_key, iv=tag_block_iv)
+        decrypted = decryptor.decrypt(tag_block)
+
+        proto_tag = decrypted[PROTO_TAG_POS-TAG_BLOCK_POS:PROTO_TAG_POS-TAG_BLOCK_POS+4]
+        if proto_tag not in (PROTO_TAG_ABRIDGED, PROTO_TAG_INTERMEDIATE, PROTO_TAG_SECURE):
+            continue
+
+        if proto_tag == PROTO_TAG_SECURE:
+            if is_tls_handshake and not config.MODES["tls"]:
+                continue
+            if not is_tls_handshake and not config.MODES["secure"]:
+                continue
+        else:
+            if not config.MODES["classic"]:
+                continue
+
+        dc_idx_pos = DC_IDX_POS - TAG_BLOCK_POS
+        dc_idx = int.from_bytes(decrypted[dc_idx_pos:dc_idx_pos+2], "little", signed=True)
+
+        enc_key = hashlib.sha256(enc_prekey + secret).digest()
+        encryptor = create_aes_ctr(key=enc_key, iv=int.from_bytes(enc_iv, "big"))
+
+        return user, proto_tag, dc_idx, decryptor, encryptor, enc_key + enc_iv
+
+    return None
+
+
 async def handle_handshake(reader, writer):
     global used_handshakes
     global client_ips
-    global last_client_ips
     global last_clients_with_same_handshake
 
     TLS_START_BYTES = b"\x16\x03\x01"
@@ -1282,59 +2762,26 @@ async def handle_handshake(reader, writer):
         handshake += await reader.readexactly(HANDSHAKE_LEN - len(handshake))
 
     dec_prekey_and_iv = handshake[SKIP_LEN:SKIP_LEN+PREKEY_LEN+IV_LEN]
-    dec_prekey, dec_iv = dec_prekey_and_iv[:PREKEY_LEN], dec_prekey_and_iv[PREKEY_LEN:]
-    enc_prekey_and_iv = handshake[SKIP_LEN:SKIP_LEN+PREKEY_LEN+IV_LEN][::-1]
-    enc_prekey, enc_iv = enc_prekey_and_iv[:PREKEY_LEN], enc_prekey_and_iv[PREKEY_LEN:]
 
     if dec_prekey_and_iv in used_handshakes:
         last_clients_with_same_handshake[peer[0]] += 1
         await handle_bad_client(reader, writer, handshake)
         return False
 
-    for user in config.USERS:
-        secret = bytes.fromhex(config.USERS[user])
-
-        dec_key = hashlib.sha256(dec_prekey + secret).digest()
-        decryptor = create_aes_ctr(key=dec_key, iv=int.from_bytes(dec_iv, "big"))
-
-        enc_key = hashlib.sha256(enc_prekey + secret).digest()
-        encryptor = create_aes_ctr(key=enc_key, iv=int.from_bytes(enc_iv, "big"))
-
-        decrypted = decryptor.decrypt(handshake)
-
-        proto_tag = decrypted[PROTO_TAG_POS:PROTO_TAG_POS+4]
-        if proto_tag not in (PROTO_TAG_ABRIDGED, PROTO_TAG_INTERMEDIATE, PROTO_TAG_SECURE):
-            continue
-
-        if proto_tag == PROTO_TAG_SECURE:
-            if is_tls_handshake and not config.MODES["tls"]:
-                continue
-            if not is_tls_handshake and not config.MODES["secure"]:
-                continue
-        else:
-            if not config.MODES["classic"]:
-                continue
-
-        dc_idx = int.from_bytes(decrypted[DC_IDX_POS:DC_IDX_POS+2], "little", signed=True)
+    user_data = find_handshake_user(handshake, is_tls_handshake)
+    if not user_data:
+        await handle_bad_client(reader, writer, handshake)
+        return False
 
-        if config.REPLAY_CHECK_LEN > 0:
-            while len(used_handshakes) >= config.REPLAY_CHECK_LEN:
-                used_handshakes.popitem(last=False)
-            used_handshakes[dec_prekey_and_iv] = True
+    user, proto_tag, dc_idx, decryptor, encryptor, enc_key_and_iv = user_data
 
-        if config.CLIENT_IPS_LEN > 0:
-            while len(client_ips) >= config.CLIENT_IPS_LEN:
-                client_ips.popitem(last=False)
-            if peer[0] not in client_ips:
-                client_ips[peer[0]] = True
-                last_client_ips[peer[0]] = True
+    used_handshakes.add(dec_prekey_and_iv)
 
-        reader = CryptoWrappedStreamReader(reader, decryptor)
-        writer = CryptoWrappedStreamWriter(writer, encryptor)
-        return reader, writer, proto_tag, user, dc_idx, enc_key + enc_iv, peer
+    client_ips.add(peer[0])
 
-    await handle_bad_client(reader, writer, handshake)
-    return False
+    reader = CryptoWrappedStreamReader(reader, decryptor)
+    writer = CryptoWrappedStreamWriter(writer, encryptor)
+    return reader, writer, proto_tag, user, dc_idx, enc_key_and_iv, peer
 
 
 async def do_direct_handshake(proto_tag, dc_idx, dec_key_and_iv=None):
@@ -1346,20 +2793,23 @@ async def do_direct_handshake(proto_tag, dc_idx, dec_key_and_iv=None):
 
     global my_ip_info
     global tg_connection_pool
+    global tg_endpoint_scores
 
     dc_idx = abs(dc_idx) - 1
 
-    if my_ip_info["ipv6"] and (config.PREFER_IPV6 or not my_ip_info["ipv4"]):
-        if not 0 <= dc_idx < len(TG_DATACENTERS_V6):
-            return False
-        dc = TG_DATACENTERS_V6[dc_idx]
-    else:
-        if not 0 <= dc_idx < len(TG_DATACENTERS_V4):
-            return False
-        dc = TG_DATACENTERS_V4[dc_idx]
+    endpoints_v6 = endpoints_v4 = []
+    if 0 <= dc_idx < len(TG_DATACENTERS_V6):
+        endpoints_v6 = [(TG_DATACENTERS_V6[dc_idx], TG_DATACENTER_PORT)]
+    if 0 <= dc_idx < len(TG_DATACENTERS_V4):
+        endpoints_v4 = [(TG_DATACENTERS_V4[dc_idx], TG_DATACENTER_PORT)]
+
+    endpoints = tg_endpoint_scores.order_by_family(endpoints_v6, endpoints_v4)
+    if not endpoints:
+        return False
+    dc = " or ".join(host for host, port in endpoints)
 
     try:
-        reader_tgt, writer_tgt = await tg_connection_pool.get_connection(dc, TG_DATACENTER_PORT)
+        reader_tgt, writer_tgt = await tg_connection_pool.get_racing_connection(endpoints)
     except ConnectionRefusedError as E:
         print_err("Got connection refused while trying to connect to", dc, TG_DATACENTER_PORT)
         return False
@@ -1539,20 +2989,23 @@ async def middleproxy_handshake(host, port, reader_tgt, writer_tgt):
 async def do_middleproxy_handshake(proto_tag, dc_idx, cl_ip, cl_port):
     global my_ip_info
     global tg_connection_pool
+    global tg_endpoint_scores
+    global middle_proxy_mux_pool
 
-    use_ipv6_tg = (my_ip_info["ipv6"] and (config.PREFER_IPV6 or not my_ip_info["ipv4"]))
-
-    if use_ipv6_tg:
-        if dc_idx not in TG_MIDDLE_PROXIES_V6:
-            return False
-        addr, port = myrandom.choice(TG_MIDDLE_PROXIES_V6[dc_idx])
-    else:
-        if dc_idx not in TG_MIDDLE_PROXIES_V4:
-            return False
-        addr, port = myrandom.choice(TG_MIDDLE_PROXIES_V4[dc_idx])
+    endpoints = tg_endpoint_scores.order_by_family(TG_MIDDLE_PROXIES_V6.get(dc_idx),
+                                                   TG_MIDDLE_PROXIES_V4.get(dc_idx))
+    if not endpoints:
+        return False
+    addr = " or ".join(host for host, port in endpoints)
+    port = endpoints[0][1]
 
     try:
-        ret = await tg_connection_pool.get_connection(addr, port, middleproxy_handshake)
+        if config.MIDDLE_PROXY_MUX_CONNS > 0:
+            # the shared connections are taken from the pool and raced like the usual ones
+            mux = await middle_proxy_mux_pool.get_mux(dc_idx, endpoints)
+            return mux.add_client(cl_ip, cl_port, proto_tag)
+
+        ret = await tg_connection_pool.get_racing_connection(endpoints, middleproxy_handshake)
         reader_tgt, writer_tgt, my_ip, my_port = ret
     except ConnectionRefusedError as E:
         print_err("The Telegram server %d (%s %s) is refusing connections" % (dc_idx, addr, port))
@@ -1570,7 +3023,50 @@ async def do_middleproxy_handshake(proto_tag, dc_idx, cl_ip, cl_port):
     return reader_tgt, writer_tgt
 
 
+def update_traffic_stats(user, is_upstream, octets, msgs):
+    if is_upstream:
+        update_user_stats(user, octets_from_client=octets, msgs_from_client=msgs)
+    else:
+        update_user_stats(user, octets_to_client=octets, msgs_to_client=msgs)
+
+
+class TrafficStatsBatch:
+    __slots__ = ('user', 'is_upstream', 'octets', 'msgs', 'flush_handle')
+
+    def __init__(self, user, is_upstream):
+        self.user = user
+        self.is_upstream = is_upstream
+        self.octets = self.msgs = 0
+        self.flush_handle = None
+
+    def add(self, octets, msgs=1):
+        self.octets += octets
+        self.msgs += msgs
+        if self.octets >= STATS_FLUSH_BYTES or config.STATS_FLUSH_PERIOD <= 0:
+            self.flush()
+        elif not self.flush_handle:
+            loop = asyncio.get_event_loop()
+            self.flush_handle = loop.call_later(config.STATS_FLUSH_PERIOD, self.flush)
+
+    def flush(self):
+        if self.flush_handle:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if self.msgs:
+            update_traffic_stats(self.user, self.is_upstream, self.octets, self.msgs)
+        self.octets = self.msgs = 0
+
+
 async def tg_connect_reader_to_writer(rd, wr, user, rd_buf_size, is_upstream):
+    # the stats are accumulated locally and flushed from time to time, it is faster
+    traffic_stats = TrafficStatsBatch(user, is_upstream)
+
+    # the drain is awaited only when the transport and the corked writes have more data than
+    # the transport wants to buffer
+    transport = wr.transport
+    high_water = transport.get_write_buffer_limits()[1]
+    corking_writer = get_corking_writer(wr)
+
     try:
         while True:
             data = await rd.read(rd_buf_size)
@@ -1587,16 +3083,315 @@ async def tg_connect_reader_to_writer(rd, wr, user, rd_buf_size, is_upstream):
                 await wr.drain()
                 return
             else:
-                if is_upstream:
-                    update_user_stats(user, octets_from_client=len(data), msgs_from_client=1)
-                else:
-                    update_user_stats(user, octets_to_client=len(data), msgs_to_client=1)
+                traffic_stats.add(len(data))
 
                 wr.write(data, extra)
+                buffered_len = transport.get_write_buffer_size()
+                if corking_writer:
+                    buffered_len += corking_writer.corked_len
+                if buffered_len > high_water or transport.is_closing():
+                    await wr.drain()
+    except (OSError, asyncio.IncompleteReadError) as e:
+        # print_err(e)
+        pass
+    finally:
+        traffic_stats.flush()
+
+
+async def tg_connect_frames_to_writer(rd, wr, user, rd_buf_size):
+    # the frames which came together are written as one batch
+    traffic_stats = TrafficStatsBatch(user, True)
+
+    transport = wr.transport
+    high_water = transport.get_write_buffer_limits()[1]
+    corking_writer = get_corking_writer(wr)
+
+    try:
+        while True:
+            frames = await rd.read_batch(rd_buf_size)
+            if not frames:
+                wr.write_eof()
+                await wr.drain()
+                return
+
+            traffic_stats.add(sum(len(msg) for msg, flags in frames), len(frames))
+
+            wr.write_batch(frames)
+            buffered_len = transport.get_write_buffer_size()
+            if corking_writer:
+                buffered_len += corking_writer.corked_len
+            if buffered_len > high_water or transport.is_closing():
                 await wr.drain()
     except (OSError, asyncio.IncompleteReadError) as e:
         # print_err(e)
         pass
+    finally:
+        traffic_stats.flush()
+
+
+def can_splice_tg_to_clt(reader_tg, writer_clt):
+    # the tg->client direction must be a plain copy between two sockets
+    if not config.USE_SPLICE or not hasattr(os, "splice"):
+        return False
+
+    if not isinstance(reader_tg, CryptoWrappedStreamReader):
+        return False
+    if not isinstance(writer_clt, CryptoWrappedStreamWriter):
+        return False
+
+    # fake tls clients need the framing, so their traffic has to go through python
+    if not isinstance(reader_tg.upstream, asyncio.StreamReader):
+        return False
+    if not isinstance(writer_clt.upstream, asyncio.StreamWriter):
+        return False
+
+    # we need to take the data already read by the stream
+    return get_stream_buffer(reader_tg.upstream) is not None
+
+
+async def wait_fd_ready(add_func, remove_func, fd):
+    fut = asyncio.get_event_loop().create_future()
+
+    def on_ready():
+        if not fut.done():
+            fut.set_result(None)
+
+    add_func(fd, on_ready)
+    try:
+        await fut
+    finally:
+        remove_func(fd)
+
+
+async def tg_splice_reader_to_writer(rd, wr_tg, wr, user, rd_buf_size):
+    # the tg->client data never gets to python bytes objects
+    import fcntl
+
+    SPLICE_FLAGS = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+
+    loop = asyncio.get_event_loop()
+
+    traffic_stats = TrafficStatsBatch(user, False)
+
+    tg_fd = clt_fd = pipe_rd = pipe_wr = None
+    write_buffer_limits = None
+    try:
+        # stop the transport from reading, the socket is ours from now
+        wr_tg.transport.pause_reading()
+
+        stream_buf = get_stream_buffer(rd.upstream)
+        data = bytes(rd.buf[rd.buf_pos:]) + bytes(stream_buf)
+        rd.buf.clear()
+        rd.buf_pos = 0
+        stream_buf.clear()
+
+        if data:
+            traffic_stats.add(len(data))
+            wr.write(data)
+
+        if rd.upstream.at_eof():
+            wr.write_eof()
+            await wr.drain()
+            return
+
+        # wait for the client transport to send everything, after that we write to the socket
+        write_buffer_limits = wr.transport.get_write_buffer_limits()
+        wr.transport.set_write_buffer_limits(0)
+        await wr.drain()
+
+        # the duplicates are needed because the event loop doesn't allow to wait for
+        # transport fds, and the transports still use the sockets in the other direction
+        tg_fd = os.dup(wr_tg.get_extra_info("socket").fileno())
+        clt_fd = os.dup(wr.get_extra_info("socket").fileno())
+        pipe_rd, pipe_wr = os.pipe()
+
+        if hasattr(fcntl, "F_SETPIPE_SZ"):
+            try:
+                fcntl.fcntl(pipe_wr, fcntl.F_SETPIPE_SZ, rd_buf_size)
+            except OSError:
+                pass
+
+        in_pipe = 0
+        while True:
+            if not in_pipe:
+                try:
+                    in_pipe = os.splice(tg_fd, pipe_wr, rd_buf_size, flags=SPLICE_FLAGS)
+                except BlockingIOError:
+                    await wait_fd_ready(loop.add_reader, loop.remove_reader, tg_fd)
+                    continue
+
+                if not in_pipe:
+                    wr.write_eof()
+                    await wr.drain()
+                    return
+
+                traffic_stats.add(in_pipe)
+
+            try:
+                in_pipe -= os.splice(pipe_rd, clt_fd, in_pipe, flags=SPLICE_FLAGS)
+            except BlockingIOError:
+                await wait_fd_ready(loop.add_writer, loop.remove_writer, clt_fd)
+    except (OSError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        traffic_stats.flush()
+
+        # the client transport can be written through asyncio after the splice
+        if write_buffer_limits and not wr.transport.is_closing():
+            low, high = write_buffer_limits
+            wr.transport.set_write_buffer_limits(high=high, low=low)
+
+        for fd in (tg_fd, clt_fd, pipe_rd, pipe_wr):
+            if fd is not None:
+                os.close(fd)
+
+
+def can_relay_with_protocols(reader_clt, writer_clt, reader_tg, writer_tg):
+    # both directions must be plain encrypted byte streams over the sockets
+    if not config.USE_PROTOCOL_RELAY or not hasattr(asyncio, "BufferedProtocol"):
+        return False
+
+    for reader, writer in ((reader_clt, writer_clt), (reader_tg, writer_tg)):
+        if not isinstance(reader, CryptoWrappedStreamReader):
+            return False
+        if not isinstance(writer, CryptoWrappedStreamWriter):
+            return False
+        if reader.block_size != 1 or writer.block_size != 1:
+            return False
+
+        # fake tls and middle proxy traffic needs the framing
+        if not isinstance(reader.upstream, asyncio.StreamReader):
+            return False
+        if not isinstance(writer.upstream, asyncio.StreamWriter):
+            return False
+
+        # the data already read by the stream is taken, like in the splice mode
+        if get_stream_buffer(reader.upstream) is None:
+            return False
+    return True
+
+
+# python 3.6 has no buffered protocols, the protocol relay is not used there
+class RelayProtocol(getattr(asyncio, "BufferedProtocol", asyncio.Protocol)):
+    # reencrypts the data from the preallocated buffer straight to the other transport
+    __slots__ = ('transport', 'peer_transport', 'peer_protocol', 'decryptor', 'encryptor',
+                 'buf', 'done', 'finish_on_drain', 'traffic_stats')
+
+    def __init__(self, transport, decryptor, encryptor, user, is_upstream, buf_size, done):
+        self.transport = transport
+        self.peer_transport = None
+        self.peer_protocol = None
+        self.decryptor = decryptor
+        self.encryptor = encryptor
+        self.buf = memoryview(bytearray(buf_size))
+        self.done = done
+        self.finish_on_drain = False
+
+        # the stats are accumulated locally and flushed from time to time, it is faster
+        self.traffic_stats = TrafficStatsBatch(user, is_upstream)
+
+    def get_buffer(self, sizehint):
+        return self.buf
+
+    def buffer_updated(self, nbytes):
+        self.relay(self.decryptor.decrypt(self.buf[:nbytes]))
+
+    def relay(self, data):
+        self.traffic_stats.add(len(data))
+
+        if not self.peer_transport.is_closing():
+            data = self.encryptor.encrypt(data)
+            # the fake ciphers return the view of the reused buffer, the transport can keep it
+            if isinstance(data, memoryview):
+                data = bytes(data)
+            self.peer_transport.write(data)
+
+    def finish(self):
+        if not self.done.done():
+            self.done.set_result(None)
+
+    def eof_received(self):
+        if self.peer_transport.is_closing():
+            self.finish()
+            return True
+
+        if self.peer_transport.can_write_eof():
+            self.peer_transport.write_eof()
+
+        # the relay is done when the other side gets all the data, resume_writing is called then
+        self.peer_protocol.finish_on_drain = True
+        self.peer_transport.set_write_buffer_limits(high=0)
+        if not self.peer_transport.get_write_buffer_size():
+            self.finish()
+        return True
+
+    def connection_lost(self, exc):
+        self.finish()
+
+    # the own transport is full, so the other side should stop reading
+    def pause_writing(self):
+        if not self.peer_transport.is_closing():
+            self.peer_transport.pause_reading()
+
+    def resume_writing(self):
+        if self.finish_on_drain:
+            self.finish()
+        elif not self.peer_transport.is_closing():
+            self.peer_transport.resume_reading()
+
+
+async def tg_protocol_relay(reader_clt, writer_clt, reader_tg, writer_tg, user):
+    # the streams are used only for the handshakes
+    done = asyncio.get_event_loop().create_future()
+
+    # with the empty write buffers the new protocols start in the not paused state
+    await writer_clt.drain()
+    await writer_tg.drain()
+
+    protocol_clt = RelayProtocol(writer_clt.transport, reader_clt.decryptor, writer_tg.encryptor,
+                                 user, True, get_to_tg_bufsize(), done)
+    protocol_tg = RelayProtocol(writer_tg.transport, reader_tg.decryptor, writer_clt.encryptor,
+                                user, False, get_to_clt_bufsize(), done)
+    protocol_clt.peer_transport = protocol_tg.transport
+    protocol_tg.peer_transport = protocol_clt.transport
+    protocol_clt.peer_protocol = protocol_tg
+    protocol_tg.peer_protocol = protocol_clt
+
+    try:
+        # both protocols are set before any data, the eof of one side waits for the other
+        protocol_clt.transport.set_protocol(protocol_clt)
+        protocol_tg.transport.set_protocol(protocol_tg)
+
+        for protocol, reader in ((protocol_clt, reader_clt), (protocol_tg, reader_tg)):
+            # the data already read by the streams goes first, it is partially decrypted
+            stream = reader.upstream
+            if len(reader.buf) > reader.buf_pos:
+                protocol.relay(bytes(reader.buf[reader.buf_pos:]))
+                reader.buf.clear()
+                reader.buf_pos = 0
+            stream_buf = get_stream_buffer(stream)
+            if stream_buf:
+                protocol.relay(protocol.decryptor.decrypt(bytes(stream_buf)))
+                stream_buf.clear()
+
+            if stream.at_eof():
+                protocol.eof_received()
+            else:
+                # the stream could pause the transport when its buffer was full
+                protocol.transport.resume_reading()
+
+        await done
+    finally:
+        protocol_clt.traffic_stats.flush()
+        protocol_tg.traffic_stats.flush()
+
+
+def get_decrypt_calls(reader):
+    while reader is not None:
+        if isinstance(reader, CryptoWrappedStreamReader):
+            return reader.decrypt_calls
+        reader = getattr(reader, "upstream", None)
+    return 0
 
 
 async def handle_client(reader_clt, writer_clt):
@@ -1661,18 +3456,32 @@ async def handle_client(reader_clt, writer_clt):
         else:
             return
 
-    tg_to_clt = tg_connect_reader_to_writer(reader_tg, writer_clt, user,
-                                            get_to_clt_bufsize(), False)
-    clt_to_tg = tg_connect_reader_to_writer(reader_clt, writer_tg,
-                                            user, get_to_tg_bufsize(), True)
-    task_tg_to_clt = asyncio.ensure_future(tg_to_clt)
-    task_clt_to_tg = asyncio.ensure_future(clt_to_tg)
+    use_splice = (connect_directly and config.FAST_MODE and
+                  can_splice_tg_to_clt(reader_tg, writer_clt))
+
+    if not use_splice and can_relay_with_protocols(reader_clt, writer_clt, reader_tg, writer_tg):
+        relay = tg_protocol_relay(reader_clt, writer_clt, reader_tg, writer_tg, user)
+        relay_tasks = [asyncio.ensure_future(relay)]
+    else:
+        if use_splice:
+            tg_to_clt = tg_splice_reader_to_writer(reader_tg, writer_tg, writer_clt, user,
+                                                   get_to_clt_bufsize())
+        else:
+            tg_to_clt = tg_connect_reader_to_writer(reader_tg, writer_clt, user,
+                                                    get_to_clt_bufsize(), False)
+        if connect_directly:
+            clt_to_tg = tg_connect_reader_to_writer(reader_clt, writer_tg,
+                                                    user, get_to_tg_bufsize(), True)
+        else:
+            clt_to_tg = tg_connect_frames_to_writer(reader_clt, writer_tg,
+                                                    user, get_to_tg_bufsize())
+        relay_tasks = [asyncio.ensure_future(tg_to_clt), asyncio.ensure_future(clt_to_tg)]
 
     update_user_stats(user, curr_connects=1)
 
     tcp_limit_hit = (
         user in config.USER_MAX_TCP_CONNS and
-        user_stats[user]["curr_connects"] > config.USER_MAX_TCP_CONNS[user]
+        get_user_stat(user, "curr_connects") > config.USER_MAX_TCP_CONNS[user]
     )
 
     user_expired = (
@@ -1682,21 +3491,24 @@ async def handle_client(reader_clt, writer_clt):
 
     user_data_quota_hit = (
         user in config.USER_DATA_QUOTA and
-        (user_stats[user]["octets_to_client"] +
-         user_stats[user]["octets_from_client"] > config.USER_DATA_QUOTA[user])
+        (get_user_stat(user, "octets_to_client") +
+         get_user_stat(user, "octets_from_client") > config.USER_DATA_QUOTA[user])
     )
 
     if (not tcp_limit_hit) and (not user_expired) and (not user_data_quota_hit):
         start = time.time()
-        await asyncio.wait([task_tg_to_clt, task_clt_to_tg], return_when=asyncio.FIRST_COMPLETED)
+        await asyncio.wait(relay_tasks, return_when=asyncio.FIRST_COMPLETED)
         update_durations(time.time() - start)
 
     update_user_stats(user, curr_connects=-1)
 
-    task_tg_to_clt.cancel()
-    task_clt_to_tg.cancel()
+    for task in relay_tasks:
+        task.cancel()
+
+    decrypt_calls = get_decrypt_calls(reader_clt) + get_decrypt_calls(reader_tg)
+    update_stats(relayed_connects=1, decrypt_calls=decrypt_calls)
 
-    writer_tg.transport.abort()
+    writer_tg.abort()
 
 
 async def handle_client_wrapper(reader, writer):
@@ -1750,6 +3562,8 @@ def make_metrics_pkt(metrics):
 
 async def handle_metrics(reader, writer):
     global stats
+    global tg_connection_pool
+    global tg_endpoint_scores
     global user_stats
     global my_ip_info
     global proxy_start_time
@@ -1763,13 +3577,42 @@ async def handle_metrics(reader, writer):
         return
 
     try:
+        all_stats, all_user_stats = get_total_stats()
+
         metrics = []
         metrics.append(["uptime", "counter", "proxy uptime", time.time() - proxy_start_time])
         metrics.append(["connects_bad", "counter", "connects with bad secret",
-                       stats["connects_bad"]])
-        metrics.append(["connects_all", "counter", "incoming connects", stats["connects_all"]])
+                       all_stats["connects_bad"]])
+        metrics.append(["connects_all", "counter", "incoming connects", all_stats["connects_all"]])
         metrics.append(["handshake_timeouts", "counter", "number of timed out handshakes",
-                       stats["handshake_timeouts"]])
+                       all_stats["handshake_timeouts"]])
+        metrics.append(["relayed_connects", "counter", "connects which got to the relaying",
+                       all_stats["relayed_connects"]])
+        metrics.append(["decrypt_calls", "counter",
+                       "decrypt calls of the relayed connects readers, per connect with " +
+                       "relayed_connects", all_stats["decrypt_calls"]])
+        metrics.append(["tg_pool_hits", "counter", "telegram connections taken from the pool",
+                       all_stats["pool_hits"]])
+        metrics.append(["tg_pool_misses", "counter",
+                       "telegram connections opened because the pool was empty",
+                       all_stats["pool_misses"]])
+
+        gauges_desc = {
+            "tg_pool_warm_conns": "ready telegram connections in the worker pool",
+            "tg_pool_target_conns": "wanted telegram connections in the worker pool",
+            "tg_endpoint_connect_time": "average telegram connect time, seconds",
+            "tg_endpoint_failures": "telegram connect failures in a row",
+            "client_ips": "remembered client ips in the worker",
+            "client_ips_mem": "memory used to remember client ips, bytes",
+        }
+
+        for name, labels, val in get_all_worker_gauges():
+            if labels:
+                metric = dict(labels)
+                metric["val"] = val
+            else:
+                metric = val
+            metrics.append([name, "gauge", gauges_desc[name], metric])
 
         if config.METRICS_EXPORT_LINKS:
             for link in proxy_links:
@@ -1783,7 +3626,7 @@ async def handle_metrics(reader, writer):
             bucket_end = bucket if bucket != STAT_DURATION_BUCKETS[-1] else "+Inf"
             metric = {
                 "bucket": "%s-%s" % (bucket_start, bucket_end),
-                "val": stats["connects_with_duration_le_%s" % str(bucket)]
+                "val": all_stats["connects_with_duration_le_%s" % str(bucket)]
             }
             metrics.append(["connects_by_duration", "counter", "connects by duration", metric])
             bucket_start = bucket_end
@@ -1802,7 +3645,7 @@ async def handle_metrics(reader, writer):
         ]
 
         for m_name, m_type, m_desc, stat_key in user_metrics_desc:
-            for user, stat in user_stats.items():
+            for user, stat in all_user_stats.items():
                 if "+" in stat_key:
                     val = 0
                     for key_part in stat_key.split("+"):
@@ -1824,27 +3667,31 @@ async def handle_metrics(reader, writer):
 
 async def stats_printer():
     global user_stats
-    global last_client_ips
+    global client_ips
     global last_clients_with_time_skew
     global last_clients_with_same_handshake
 
     while True:
         await asyncio.sleep(config.STATS_PRINT_PERIOD)
 
-        print("Stats for", time.strftime("%d.%m.%Y %H:%M:%S"))
-        for user, stat in user_stats.items():
-            print("%s: %d connects (%d current), %.2f MB, %d msgs" % (
-                user, stat["connects"], stat["curr_connects"],
-                (stat["octets_from_client"] + stat["octets_to_client"]) / 1000000,
-                stat["msgs_from_client"] + stat["msgs_to_client"]))
-        print(flush=True)
+        # the totals are the same in all the workers, so only the first one prints them
+        if not worker_idx:
+            all_stats, all_user_stats = get_total_stats()
+
+            print("Stats for", time.strftime("%d.%m.%Y %H:%M:%S"))
+            for user, stat in all_user_stats.items():
+                print("%s: %d connects (%d current), %.2f MB, %d msgs" % (
+                    user, stat["connects"], stat["curr_connects"],
+                    (stat["octets_from_client"] + stat["octets_to_client"]) / 1000000,
+                    stat["msgs_from_client"] + stat["msgs_to_client"]))
+            print(flush=True)
 
-        if last_client_ips:
+        new_client_ips = client_ips.pop_new_ips()
+        if new_client_ips:
             print("New IPs:")
-            for ip in last_client_ips:
+            for ip in new_client_ips:
                 print(ip)
             print(flush=True)
-            last_client_ips.clear()
 
         if last_clients_with_time_skew:
             print("Clients with time skew (possible replay-attackers):")
@@ -2017,9 +3864,19 @@ async def get_srv_time():
         except Exception as E:
             print_err("Error getting server time", E)
 
+        publish_tg_info()
         await asyncio.sleep(config.GET_TIME_PERIOD)
 
 
+async def maintain_tg_connection_pool():
+    global tg_connection_pool
+    while True:
+        await asyncio.sleep(TgConnectionPool.MAINTAIN_PERIOD)
+        tg_connection_pool.maintain()
+        # the metrics can be served by the other worker, so the gauges are shared in advance
+        publish_worker_gauges()
+
+
 async def clear_ip_resolving_cache():
     global mask_host_cached_ip
     min_sleep = myrandom.randrange(60 - 10, 60 + 10)
@@ -2082,9 +3939,48 @@ async def update_middle_proxy_info():
         except Exception as E:
             print_err("Error updating middle proxy secret, using old", E)
 
+        publish_tg_info()
         await asyncio.sleep(config.PROXY_INFO_UPDATE_PERIOD)
 
 
+def publish_tg_info():
+    if not shared_tg_info:
+        return
+
+    shared_tg_info.publish({
+        "middle_proxies_v4": list(TG_MIDDLE_PROXIES_V4.items()),
+        "middle_proxies_v6": list(TG_MIDDLE_PROXIES_V6.items()),
+        "proxy_secret": PROXY_SECRET.hex(),
+        "disable_middle_proxy": disable_middle_proxy,
+        "is_time_skewed": is_time_skewed,
+    })
+
+
+async def load_shared_tg_info():
+    # the info is polled by the first worker
+    LOAD_PERIOD = 5
+
+    global TG_MIDDLE_PROXIES_V4
+    global TG_MIDDLE_PROXIES_V6
+    global PROXY_SECRET
+    global disable_middle_proxy
+    global is_time_skewed
+
+    def to_proxies_dict(items):
+        return {dc_idx: [(host, port) for host, port in proxies] for dc_idx, proxies in items}
+
+    while True:
+        info = shared_tg_info.load()
+        if info:
+            TG_MIDDLE_PROXIES_V4 = to_proxies_dict(info["middle_proxies_v4"])
+            TG_MIDDLE_PROXIES_V6 = to_proxies_dict(info["middle_proxies_v6"])
+            PROXY_SECRET = bytes.fromhex(info["proxy_secret"])
+            disable_middle_proxy = info["disable_middle_proxy"]
+            is_time_skewed = info["is_time_skewed"]
+
+        await asyncio.sleep(LOAD_PERIOD)
+
+
 def init_ip_info():
     global my_ip_info
     global disable_middle_proxy
@@ -2214,10 +4110,15 @@ def setup_signals():
     if hasattr(signal, 'SIGUSR2'):
         def reload_signal(signum, frame):
             init_config()
+            init_user_secrets()
+            init_used_handshakes()
+            init_client_ips()
             ensure_users_in_user_stats()
             apply_upstream_proxy_settings()
-            print("Config reloaded", flush=True, file=sys.stderr)
-            print_tg_info()
+            # the workers get the signal from the supervisor, which prints the info itself
+            if worker_idx is None:
+                print("Config reloaded", flush=True, file=sys.stderr)
+                print_tg_info()
 
         signal.signal(signal.SIGUSR2, reload_signal)
 
@@ -2270,7 +4171,7 @@ def loop_exception_handler(loop, context):
     loop.default_exception_handler(context)
 
 
-def create_servers(loop):
+def create_servers(loop, unix_sock=None):
     servers = []
 
     reuse_port = hasattr(socket, "SO_REUSEPORT")
@@ -2286,21 +4187,27 @@ def create_servers(loop):
                                     limit=get_to_tg_bufsize(), reuse_port=reuse_port)
         servers.append(loop.run_until_complete(task))
 
-    if config.LISTEN_UNIX_SOCK and has_unix:
+    if unix_sock:
+        # the unix socket can't be reused by port, so the workers share the supervisor's one
+        task = asyncio.start_unix_server(handle_client_wrapper, sock=unix_sock,
+                                         limit=get_to_tg_bufsize())
+        servers.append(loop.run_until_complete(task))
+    elif config.LISTEN_UNIX_SOCK and has_unix:
         remove_unix_socket(config.LISTEN_UNIX_SOCK)
         task = asyncio.start_unix_server(handle_client_wrapper, config.LISTEN_UNIX_SOCK,
                                          limit=get_to_tg_bufsize())
         servers.append(loop.run_until_complete(task))
         os.chmod(config.LISTEN_UNIX_SOCK, 0o666)
 
+    # every worker can answer the metrics requests, the stats are shared
     if config.METRICS_PORT is not None:
         if config.METRICS_LISTEN_ADDR_IPV4:
             task = asyncio.start_server(handle_metrics, config.METRICS_LISTEN_ADDR_IPV4,
-                                        config.METRICS_PORT)
+                                        config.METRICS_PORT, reuse_port=reuse_port)
             servers.append(loop.run_until_complete(task))
         if config.METRICS_LISTEN_ADDR_IPV6 and socket.has_ipv6:
             task = asyncio.start_server(handle_metrics, config.METRICS_LISTEN_ADDR_IPV6,
-                                        config.METRICS_PORT)
+                                        config.METRICS_PORT, reuse_port=reuse_port)
             servers.append(loop.run_until_complete(task))
 
     return servers
@@ -2312,7 +4219,11 @@ def create_utilitary_tasks(loop):
     stats_printer_task = asyncio.Task(stats_printer(), loop=loop)
     tasks.append(stats_printer_task)
 
-    if config.USE_MIDDLE_PROXY:
+    # with the workers only the first one polls the telegram servers, the others load its info
+    if config.USE_MIDDLE_PROXY and shared_tg_info and worker_idx != 0:
+        tg_info_loader_task = asyncio.Task(load_shared_tg_info(), loop=loop)
+        tasks.append(tg_info_loader_task)
+    elif config.USE_MIDDLE_PROXY:
         middle_proxy_updater_task = asyncio.Task(update_middle_proxy_info(), loop=loop)
         tasks.append(middle_proxy_updater_task)
 
@@ -2326,23 +4237,16 @@ def create_utilitary_tasks(loop):
     clear_resolving_cache_task = asyncio.Task(clear_ip_resolving_cache(), loop=loop)
     tasks.append(clear_resolving_cache_task)
 
-    return tasks
+    pool_maintainer_task = asyncio.Task(maintain_tg_connection_pool(), loop=loop)
+    tasks.append(pool_maintainer_task)
 
+    return tasks
 
-def main():
-    init_config()
-    ensure_users_in_user_stats()
-    apply_upstream_proxy_settings()
-    init_ip_info()
-    print_tg_info()
 
-    setup_asyncio()
-    setup_files_limit()
+def run_event_loop(unix_sock=None):
     setup_signals()
     try_setup_uvloop()
 
-    init_proxy_start_time()
-
     if sys.platform == "win32":
         loop = asyncio.ProactorEventLoop()
     else:
@@ -2355,7 +4259,7 @@ def main():
     for task in utilitary_tasks:
         asyncio.ensure_future(task)
 
-    servers = create_servers(loop)
+    servers = create_servers(loop, unix_sock)
 
     try:
         loop.run_forever()
@@ -2377,11 +4281,139 @@ def main():
 
     has_unix = hasattr(socket, "AF_UNIX")
 
-    if config.LISTEN_UNIX_SOCK and has_unix:
+    if config.LISTEN_UNIX_SOCK and has_unix and not unix_sock:
         remove_unix_socket(config.LISTEN_UNIX_SOCK)
 
     loop.close()
 
 
+def is_multiprocess_mode():
+    return config.WORKERS > 1 and hasattr(os, "fork")
+
+
+def run_workers():
+    # the dead workers are restarted, the stats are in the shared memory
+    global shared_stats
+    global shared_tg_info
+
+    # enough for all the users stats and the space for users added on config reload
+    SHARED_STATS_MIN_KEYS = 4096
+    SHARED_STATS_KEYS_PER_USER = 32
+    RESTART_DELAY = 1
+
+    max_keys = max(SHARED_STATS_MIN_KEYS, len(config.USERS) * SHARED_STATS_KEYS_PER_USER)
+    shared_stats = SharedStats(config.WORKERS, max_keys)
+    shared_tg_info = SharedTgInfo()
+
+    if config.REPLAY_CHECK_LEN > 0 and config.REPLAY_CHECK_STORE != "bloom":
+        print_err("The replay check works per worker, set REPLAY_CHECK_STORE to bloom to share it")
+
+    unix_sock = None
+    if config.LISTEN_UNIX_SOCK and hasattr(socket, "AF_UNIX"):
+        remove_unix_socket(config.LISTEN_UNIX_SOCK)
+        unix_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        unix_sock.bind(config.LISTEN_UNIX_SOCK)
+        os.chmod(config.LISTEN_UNIX_SOCK, 0o666)
+
+    workers = {}
+
+    def start_worker(idx):
+        global worker_idx
+        global myrandom
+
+        pid = os.fork()
+        if pid:
+            workers[pid] = idx
+            return
+
+        exit_code = 0
+        try:
+            worker_idx = idx
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            # the workers must not share the random state with each other
+            random.seed()
+            myrandom = MyRandom()
+            run_event_loop(unix_sock)
+        except BaseException:
+            traceback.print_exc()
+            exit_code = 1
+        finally:
+            os._exit(exit_code)
+
+    def reload_signal(signum, frame):
+        init_config()
+        init_user_secrets()
+        init_used_handshakes()
+        print("Config reloaded", flush=True, file=sys.stderr)
+        print_tg_info()
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGUSR2)
+            except ProcessLookupError:
+                pass
+
+    def stop_signal(signum, frame):
+        raise KeyboardInterrupt()
+
+    signal.signal(signal.SIGTERM, stop_signal)
+    if hasattr(signal, "SIGUSR2"):
+        signal.signal(signal.SIGUSR2, reload_signal)
+
+    for idx in range(config.WORKERS):
+        start_worker(idx)
+    print_err("Started %d workers" % config.WORKERS)
+
+    try:
+        while True:
+            pid, status = os.wait()
+            idx = workers.pop(pid, None)
+            if idx is None:
+                continue
+
+            print_err("Worker %d exited with status %d, restarting" % (idx, status))
+            # the connections of the dead worker are closed
+            shared_stats.reset_worker(idx, ("s:curr_connects", "u:curr_connects:", "g:"))
+            time.sleep(RESTART_DELAY)
+            start_worker(idx)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+        for pid in workers:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+
+        if unix_sock:
+            remove_unix_socket(config.LISTEN_UNIX_SOCK)
+
+
+def main():
+    init_config()
+    init_user_secrets()
+    init_used_handshakes()
+    init_client_ips()
+    ensure_users_in_user_stats()
+    apply_upstream_proxy_settings()
+    init_ip_info()
+    print_tg_info()
+
+    setup_asyncio()
+    setup_files_limit()
+
+    init_proxy_start_time()
+
+    if is_multiprocess_mode():
+        run_workers()
+    else:
+        run_event_loop()
+
+
 if __name__ == "__main__":
     main()